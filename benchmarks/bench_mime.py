@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+'''
+Bytes read and CPU time spent on link previews of binary files.
+
+Every file of the fixture corpus is previewed, once with its proper content
+type and once as application/octet-stream, by the link previewer and by
+the former approach of downloading up to 100 KB, trying to gunzip it,
+looking for a title and running libmagic over the whole buffer. The files
+are served at a limited rate, otherwise the socket buffers of localhost
+would take in whole bodies before the client hangs up.
+
+usage: python benchmarks/bench_mime.py [--size BYTES] [--rate BYTES] [--repeat N]
+'''
+import argparse
+import asyncio
+import gzip
+import os
+import sys
+import tempfile
+import time
+import types
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fixtures import FixtureServer, file_kinds  # noqa: E402
+
+
+def install_config(store_path):
+    # the link previewer reads its configuration from the `config` module
+    config = types.ModuleType('config')
+    config.store_path = store_path
+    config.user_agent = 'delator-bench'
+    sys.modules['config'] = config
+
+
+async def legacy_preview(mli, http, url):
+    # the former path: a 100 KB prefix of any body is analyzed
+    from builtin import TitleReader
+    async with http.get(url) as response:
+        reader = TitleReader(response.charset)
+        async for data in response.content.iter_any():
+            if reader.feed(data) or len(reader.buffer) >= mli.chunk_size:
+                break
+        buffer = bytes(reader.buffer)
+    try:
+        buffer = gzip.decompress(buffer)
+    except (OSError, EOFError):
+        pass
+    reader = TitleReader()
+    reader.feed(buffer)
+    if reader.title() is None:
+        return mli.magic.from_buffer(buffer)
+
+
+async def measure(preview, urls, repeat):
+    # per pass over the corpus: bytes received, cpu and wall clock time
+    from httpclient import received_bytes
+    received = received_bytes.labels().value
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for url in urls:
+            await preview(url)
+    return ((received_bytes.labels().value - received) / repeat,
+            (time.process_time() - cpu_started) / repeat,
+            (time.perf_counter() - started) / repeat)
+
+
+async def run(args):
+    install_config(tempfile.mkdtemp(prefix='delator-bench-'))
+    from builtin import MessageLinksInfo
+    from httpclient import HTTPClient
+
+    fixtures = FixtureServer(file_size=args.size, file_rate=args.rate)
+    await fixtures.start()
+    http = HTTPClient()
+    mli = MessageLinksInfo(http)
+
+    print(f'{"":<10}{"legacy":>30}{"new":>30}')
+    print(f'{"corpus":<10}' + f'{"KiB":>10}{"cpu, ms":>10}{"wall, ms":>10}' * 2)
+    for typed in (True, False):
+        urls = [f'{fixtures.url}/file/{kind}' + ('' if typed else '?untyped=1')
+                for kind in file_kinds]
+        legacy = await measure(lambda url: legacy_preview(mli, http, url),
+                               urls, args.repeat)
+        # youtube_dl is left out, it is the same in both cases
+        new = await measure(mli._fetch_page, urls, args.repeat)
+        print(f'{"typed" if typed else "untyped":<10}' + ''.join(
+            f'{received / 1024:>10.1f}{cpu * 1000:>10.1f}{wall * 1000:>10.1f}'
+            for received, cpu, wall in (legacy, new)))
+
+    for kind in file_kinds:
+        line, _ = mli._describe(await mli._fetch_page(
+            f'{fixtures.url}/file/{kind}?untyped=1'))
+        print(f'{kind}: {line}')
+
+    mli.close()
+    await http.close()
+    await fixtures.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=2**20,
+                        help='size of every file of the corpus in bytes')
+    parser.add_argument('--rate', type=int, default=10 * 2**20,
+                        help='bandwidth of the fixture server in bytes per second')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='passes over the corpus, the average is reported')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+'''
+Load test of the HTTP endpoint of the %poll command.
+
+The endpoint is run in-process with its storage in a temporary directory
+and hammered over keep-alive connections: vote codes one request at a
+time, the same amount of codes in batches, and revalidation of cached
+options with ETags. Reported are requests and codes per second and
+latency percentiles.
+
+usage: python benchmarks/bench_poll_http.py [--codes N] [--concurrency N] ...
+'''
+import argparse
+import asyncio
+import importlib.util
+import os
+import socket
+import sys
+import tempfile
+import time
+import types
+
+import aiohttp
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(__file__))
+
+from loadtest import percentiles  # noqa: E402
+
+
+def install_config(store_path):
+    # the command storage reads its configuration from the `config` module
+    config = types.ModuleType('config')
+    config.store_path = store_path
+    sys.modules['config'] = config
+
+
+def load_poll():
+    spec = importlib.util.spec_from_file_location(
+        'poll', os.path.join(root, 'commands', 'poll.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def run_requests(count, concurrency, request):
+    # count requests made by concurrency workers, returns their latencies
+    latencies = []
+    counter = iter(range(count))
+
+    async def worker():
+        for n in counter:
+            started = time.perf_counter()
+            await request(n)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+def report(name, amount, unit, elapsed, latencies, failed=0):
+    print(f'{name:<10}{amount / elapsed:>10.0f} {unit}/s   '
+          f'{percentiles(latencies)}')
+    if failed:
+        print(f'          {failed} requests failed (e.g. 429 with --rate-limit), '
+              'not counted above')
+
+
+async def run(args):
+    store_path = tempfile.mkdtemp(prefix='delator-bench-')
+    install_config(store_path)
+    from command import Storage
+    from store import KVStore
+
+    poll = load_poll()
+    poll.port = free_port()
+    if not args.rate_limit:
+        poll.limiter = poll.RateLimiter(1e9, 1e9, 1)
+    kv = KVStore(os.path.join(store_path, 'storage.db'))
+    await poll.setup(Storage('poll', kv))
+
+    options = [f'option {n}' for n in range(args.options)]
+    ids = [poll.polls.start('@bench:localhost', options) for _ in range(args.polls)]
+    base = f'http://127.0.0.1:{poll.port}{poll.uri}'
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        failed = 0
+
+        async def single(n):
+            nonlocal failed
+            id = ids[n % len(ids)]
+            async with session.get(f'{base}{id}/{options[n % len(options)]}') as r:
+                await r.read()
+                failed += r.status != 200
+
+        started = time.perf_counter()
+        latencies = await run_requests(args.codes, args.concurrency, single)
+        report('single', args.codes - failed, 'codes', time.perf_counter() - started,
+               latencies, failed)
+
+        batches = (args.codes + args.batch - 1) // args.batch
+
+        failed = 0
+
+        async def batch(n):
+            nonlocal failed
+            items = [{'id': ids[(n * args.batch + i) % len(ids)],
+                      'answer': options[i % len(options)]}
+                     for i in range(args.batch)]
+            async with session.post(f'{base}codes', json=items) as r:
+                await r.read()
+                if r.status != 200:
+                    failed += 1
+
+        started = time.perf_counter()
+        latencies = await run_requests(batches, args.concurrency, batch)
+        report('batch', (batches - failed) * args.batch, 'codes',
+               time.perf_counter() - started, latencies, failed)
+
+        etags = {}
+        for id in ids:
+            async with session.get(f'{base}{id}') as r:
+                # missing when the request was rate limited
+                etags[id] = r.headers.get('ETag', '')
+        not_modified = 0
+
+        async def revalidate(n):
+            nonlocal not_modified
+            id = ids[n % len(ids)]
+            async with session.get(f'{base}{id}',
+                                   headers={'If-None-Match': etags[id]}) as r:
+                await r.read()
+                not_modified += r.status == 304
+
+        started = time.perf_counter()
+        latencies = await run_requests(args.codes, args.concurrency, revalidate)
+        report('options', args.codes, 'requests', time.perf_counter() - started, latencies)
+        print(f'          {not_modified} of {args.codes} answered with 304')
+
+        async with session.get(f'{base}?ids={",".join(ids[:args.batch])}') as r:
+            print(f'batch of {min(args.batch, len(ids))} options: '
+                  f'{len(await r.read())} bytes')
+
+    await poll.teardown(None)
+    kv.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--codes', type=int, default=20000,
+                        help='codes requested in every mode')
+    parser.add_argument('--batch', type=int, default=200,
+                        help='codes per batch request, at most client_burst '
+                        'with --rate-limit')
+    parser.add_argument('--polls', type=int, default=100)
+    parser.add_argument('--options', type=int, default=4,
+                        help='options per poll')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='simultaneous keep-alive connections')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the per-client rate limit on')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''
+Per-event cost of recognizing commands in messages.
+Compares the router with the former approach of running
+an uncompiled regular expression over every message.
+
+usage: python benchmarks/bench_router.py [-n NUMBER]
+'''
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from router import Router  # noqa: E402
+
+
+names = ['dice', 'd', 'echo', 'ping', 'help', 'h', 'olm', 'poll',
+         'rss', 'search', 's', 'todo']
+
+messages = {
+    'plain': 'just a regular message in a room, nothing to see here',
+    'link': 'look at this https://example.com/some/page?with=query',
+    'command': '%search python asyncio semaphore',
+    'abbreviation': '%sea python asyncio semaphore',
+    'unknown': '%nosuchcommand with some arguments'
+}
+
+
+def legacy_route(commands, message):
+    match = re.findall(r'^%([\w\d_]*)\s?(.*)$', message)
+    if match:
+        command, args = match[0][0], match[0][1].split()
+        if command in commands:
+            return (commands[command], args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='iterations per run')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='runs per case, the fastest one is reported')
+    args = parser.parse_args()
+
+    commands = {name: object() for name in names}
+    router = Router()
+    router.build(commands)
+
+    print(f'{"message":<14}{"legacy, ns":>12}{"router, ns":>12}')
+    for kind, message in messages.items():
+        legacy = min(timeit.repeat(lambda: legacy_route(commands, message),
+                                   number=args.number, repeat=args.repeat))
+        routed = min(timeit.repeat(lambda: router.route(message),
+                                   number=args.number, repeat=args.repeat))
+        print(f'{kind:<14}{legacy * 1e9 / args.number:>12.0f}'
+              f'{routed * 1e9 / args.number:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
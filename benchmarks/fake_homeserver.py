@@ -0,0 +1,183 @@
+'''
+A stand-in Matrix homeserver serving synthetic /sync batches.
+
+Every generated message carries a unique token like "bench-42". The bot's
+replies are expected to quote it (%echo does, link previews quote the
+page title that contains it), which is how the latency of every single
+message is measured: from the moment the batch with the event was served
+to the moment the reply containing the token was received.
+'''
+import asyncio
+import itertools
+import json
+import re
+import time
+
+from aiohttp import web
+
+
+token_regex = re.compile(r'bench-(\d+)')
+
+
+class FakeHomeserver:
+    def __init__(self, user, rooms=10, batches=50, events=20,
+                 commands=0.2, links=0.1, fixtures_url=None,
+                 send_delay=0, host='127.0.0.1', port=0):
+        self.user = user
+        self.sender = '@bench:localhost'
+        self.room_ids = [f'!room{n}:localhost' for n in range(rooms)]
+        self.batches = batches
+        self.events = events
+        self.commands = commands
+        self.links = links
+        self.fixtures_url = fixtures_url
+        # latency of every room_send, in seconds
+        self.send_delay = send_delay
+        self.host = host
+        self.port = port
+
+        self.counter = itertools.count()
+        self.batch = 0
+        # token -> (kind, time the event was served)
+        self.expected = {}
+        # kind -> list of latencies in seconds
+        self.latencies = {'command': [], 'link': []}
+        self.events_served = 0
+        self.sends = 0
+        self.started = None
+        self.finished = asyncio.Event()
+
+        self.app = web.Application()
+        for version in ('r0', 'v3'):
+            prefix = f'/_matrix/client/{version}'
+            self.app.router.add_post(f'{prefix}/login', self.login)
+            self.app.router.add_get(f'{prefix}/sync', self.sync)
+            self.app.router.add_put(
+                prefix + '/rooms/{room_id}/send/{type}/{txn_id}', self.send)
+            self.app.router.add_post(
+                prefix + '/user/{user_id}/filter', self.filter)
+        self.app.router.add_get('/_matrix/client/versions', self.versions)
+        self.runner = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def versions(self, request):
+        return web.json_response({'versions': ['r0.6.1', 'v1.1']})
+
+    async def login(self, request):
+        return web.json_response({
+            'user_id': self.user,
+            'access_token': 'bench-access-token',
+            'device_id': 'BENCH'
+        })
+
+    async def filter(self, request):
+        return web.json_response({'filter_id': 'bench'})
+
+    def _event(self, room_id, content, event_type='m.room.message', **extra):
+        n = next(self.counter)
+        event = {
+            'event_id': f'$bench{n}:localhost',
+            'sender': self.sender,
+            'type': event_type,
+            'origin_server_ts': int(time.time() * 1000),
+            'content': content,
+            'unsigned': {'age': 0}
+        }
+        event.update(extra)
+        return event
+
+    def _message(self, room_id, index):
+        n = next(self.counter)
+        token = f'bench-{n}'
+        position = (index + 0.5) / self.events
+        if position < self.commands:
+            self.expected[token] = ('command', time.time())
+            body = f'%echo {token}'
+        elif position < self.commands + self.links and self.fixtures_url:
+            self.expected[token] = ('link', time.time())
+            body = f'look at {self.fixtures_url}/page/{n}'
+        else:
+            body = f'just chatting, {token}'
+        return self._event(room_id, {'msgtype': 'm.text', 'body': body})
+
+    def _room(self, events, state=()):
+        return {
+            'timeline': {'events': events, 'limited': False,
+                         'prev_batch': f'p{self.batch}'},
+            'state': {'events': list(state)},
+            'account_data': {'events': []},
+            'ephemeral': {'events': []},
+            'summary': {},
+            'unread_notifications': {}
+        }
+
+    def _membership(self, room_id):
+        return [
+            self._event(room_id, {'creator': self.sender}, 'm.room.create',
+                        state_key=''),
+            self._event(room_id, {'membership': 'join'}, 'm.room.member',
+                        state_key=self.user, sender=self.user),
+            self._event(room_id, {'membership': 'join'}, 'm.room.member',
+                        state_key=self.sender)
+        ]
+
+    def _response(self, joins):
+        return {
+            'next_batch': f's{self.batch}',
+            'rooms': {'join': joins, 'invite': {}, 'leave': {}},
+            'to_device': {'events': []},
+            'device_lists': {'changed': [], 'left': []},
+            'device_one_time_keys_count': {},
+            'presence': {'events': []},
+            'account_data': {'events': []}
+        }
+
+    async def sync(self, request):
+        if self.batch == 0:
+            # the initial sync only brings the rooms in
+            self.batch += 1
+            return web.json_response(self._response(
+                {room_id: self._room([], self._membership(room_id))
+                 for room_id in self.room_ids}))
+        if self.batch > self.batches:
+            timeout = min(int(request.query.get('timeout', 0)), 1000)
+            await asyncio.sleep(timeout / 1000)
+            return web.json_response(self._response({}))
+
+        if self.started is None:
+            self.started = time.time()
+        joins = {}
+        for room_id in self.room_ids:
+            joins[room_id] = self._room(
+                [self._message(room_id, index) for index in range(self.events)])
+            self.events_served += self.events
+        self.batch += 1
+        return web.json_response(self._response(joins))
+
+    async def send(self, request):
+        now = time.time()
+        self.sends += 1
+        content = json.loads(await request.text())
+        for n in token_regex.findall(content.get('body', '')):
+            expected = self.expected.pop(f'bench-{n}', None)
+            if expected:
+                kind, served = expected
+                self.latencies[kind].append(now - served)
+        if self.batch > self.batches and not self.expected:
+            self.finished.set()
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        return web.json_response({'event_id': f'$reply{self.sends}:localhost'})
@@ -0,0 +1,145 @@
+'''
+A local http server with fixtures for link previews and RSS feeds.
+
+/page/{n}          an html page titled "fixture bench-{n}"
+/feed/{n}          an RSS feed, a new item is published every period seconds
+/file/{kind}       a binary file (png, jpeg, pdf, zip, gzip, mp4) of file_size
+                   bytes sent at file_rate bytes per second,
+                   ?untyped=1 sends it as application/octet-stream
+'''
+import asyncio
+import gzip
+import random
+import time
+from email.utils import formatdate
+
+from aiohttp import web
+
+
+page_template = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>fixture bench-{n}</title>
+</head>
+<body>
+{filler}
+</body>
+</html>
+'''
+
+feed_template = '''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+<channel>
+<title>fixture feed {n}</title>
+<link>http://localhost/feed/{n}</link>
+<description>benchmark fixture</description>
+{items}
+</channel>
+</rss>
+'''
+
+item_template = '''<item>
+<title>item {i} of feed {n}</title>
+<link>http://localhost/feed/{n}/{i}</link>
+<guid>feed-{n}-item-{i}</guid>
+<pubDate>{date}</pubDate>
+</item>
+'''
+
+
+# magic numbers the files start with and their content types
+file_kinds = {
+    'png': (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR', 'image/png'),
+    'jpeg': (b'\xff\xd8\xff\xe0\x00\x10JFIF\x00', 'image/jpeg'),
+    'pdf': (b'%PDF-1.4\n', 'application/pdf'),
+    'zip': (b'PK\x03\x04\x14\x00\x00\x00\x08\x00', 'application/zip'),
+    'gzip': (None, 'application/gzip'),
+    'mp4': (b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom', 'video/mp4')
+}
+
+
+def make_file(kind, size):
+    # incompressible, so that the transfer is as long as the file
+    noise = random.Random(kind).getrandbits(size * 8).to_bytes(size, 'big')
+    magic_bytes, _ = file_kinds[kind]
+    if magic_bytes is None:
+        return gzip.compress(noise)[:size]
+    return magic_bytes + noise[len(magic_bytes):]
+
+
+class FixtureServer:
+    def __init__(self, host='127.0.0.1', port=0, page_size=100000,
+                 items=20, period=60, file_size=2**20, file_rate=None):
+        self.host = host
+        self.port = port
+        # pages are padded to this size after the title
+        self.filler = '<p>filler</p>\n' * (page_size // 14)
+        self.items = items
+        self.period = period
+        self.requests = 0
+        self.files = {kind: make_file(kind, file_size) for kind in file_kinds}
+        self.file_rate = file_rate
+
+        self.app = web.Application()
+        self.app.router.add_get('/page/{n}', self.page)
+        self.app.router.add_get('/feed/{n}', self.feed)
+        self.app.router.add_get('/file/{kind}', self.file)
+        self.runner = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def page(self, request):
+        self.requests += 1
+        n = request.match_info['n']
+        return web.Response(text=page_template.format(n=n, filler=self.filler),
+                            content_type='text/html')
+
+    async def feed(self, request):
+        self.requests += 1
+        n = request.match_info['n']
+        latest = int(time.time() // self.period)
+        etag = f'"{n}-{latest}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        items = ''.join(
+            item_template.format(n=n, i=i, date=formatdate(i * self.period))
+            for i in range(latest, latest - self.items, -1))
+        return web.Response(text=feed_template.format(n=n, items=items),
+                            content_type='application/rss+xml',
+                            headers={'ETag': etag})
+
+    async def file(self, request):
+        self.requests += 1
+        kind = request.match_info['kind']
+        if kind not in self.files:
+            raise web.HTTPNotFound()
+        content_type = 'application/octet-stream' if request.query.get('untyped') \
+            else file_kinds[kind][1]
+        if not self.file_rate:
+            return web.Response(body=self.files[kind], content_type=content_type)
+        # a link of limited bandwidth, the client may hang up at any moment
+        body = self.files[kind]
+        response = web.StreamResponse(headers={'Content-Type': content_type})
+        response.content_length = len(body)
+        await response.prepare(request)
+        chunk = 16384
+        try:
+            for start in range(0, len(body), chunk):
+                await response.write(body[start:start + chunk])
+                await asyncio.sleep(chunk / self.file_rate)
+        except ConnectionError:
+            pass
+        return response
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+'''
+Offline load test of the bot against a local stand-in homeserver.
+
+The real Bot is run with a generated configuration (encryption disabled,
+everything stored in a temporary directory) against FakeHomeserver, link
+previews and feeds are served by FixtureServer. Reported are the event
+throughput of the sync callback, latency percentiles of commands and link
+previews, the time of a feeder cycle, the time of delivering its updates
+to every room and the memory footprint.
+
+usage: python benchmarks/loadtest.py [--rooms N] [--batches N] ...
+'''
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_homeserver import FakeHomeserver  # noqa: E402
+from fixtures import FixtureServer  # noqa: E402
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return 'n/a'
+    values = sorted(values)
+    result = []
+    for point in points:
+        index = min(int(len(values) * point / 100), len(values) - 1)
+        result.append(f'p{point}={values[index] * 1000:.1f}ms')
+    return ', '.join(result) + f' (n={len(values)})'
+
+
+def install_config(args, store_path, server_url):
+    # the bot reads its configuration from the `config` module
+    config = types.ModuleType('config')
+    config.server = server_url
+    config.user = '@delator:localhost'
+    config.device_id = 'BENCH'
+    config.password = 'bench'
+    config.pickle_key = 'bench'
+    config.store_name = 'bench'
+    config.store_path = store_path
+    config.manager_accounts = ('@bench:localhost',)
+    config.user_agent = 'delator-loadtest'
+    config.encryption = False
+    config.send_rate = args.send_rate
+    config.send_burst = args.send_rate
+    sys.modules['config'] = config
+
+
+async def run(args):
+    fixtures = FixtureServer(page_size=args.page_size)
+    await fixtures.start()
+    homeserver = FakeHomeserver(
+        '@delator:localhost', rooms=args.rooms, batches=args.batches,
+        events=args.events, commands=args.commands, links=args.links,
+        fixtures_url=fixtures.url, send_delay=args.send_delay)
+    await homeserver.start()
+
+    store_path = tempfile.mkdtemp(prefix='delator-bench-')
+    install_config(args, store_path, homeserver.url)
+    os.chdir(root)
+    from bot import Bot
+
+    tracemalloc.start()
+    bot = Bot(loglevel=args.loglevel)
+    await bot.client.login('bench')
+
+    started = time.time()
+    sync_task = asyncio.ensure_future(bot.client.sync_forever(1000))
+    bot.tasks = [sync_task]
+    try:
+        await asyncio.wait_for(homeserver.finished.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f'timed out, {len(homeserver.expected)} replies are missing')
+    elapsed = time.time() - (homeserver.started or started)
+
+    feeder_time = delivery_time = None
+    if args.feeds:
+        for n in range(args.feeds):
+            await bot.feeder.add_feed(f'{fixtures.url}/feed/{n}')
+        # make every feed due right now
+        for feed in bot.feeder.feeds.values():
+            feed.next_poll = 0
+            bot.feeder._schedule(feed)
+        feeder_started = time.time()
+        await bot.feeder.get_updates()
+        feeder_time = time.time() - feeder_started
+
+        # the fixture feeds have nothing new yet, the updates are made up
+        updates = [{'feed': url, 'title': f'entry {n}', 'url': f'{url}#{n}'}
+                   for n, url in enumerate(bot.feeder.feeds)]
+        delivery_started = time.time()
+        await asyncio.gather(*bot._deliver_updates(updates))
+        delivery_time = time.time() - delivery_started
+
+    current, peak = tracemalloc.get_traced_memory()
+    await bot.shutdown()
+    await homeserver.stop()
+    await fixtures.stop()
+
+    print(f'events:        {homeserver.events_served} in {elapsed:.2f}s, '
+          f'{homeserver.events_served / elapsed:.0f} events/s')
+    print(f'commands:      {percentiles(homeserver.latencies["command"])}')
+    print(f'link previews: {percentiles(homeserver.latencies["link"])}')
+    print(f'messages sent: {homeserver.sends}')
+    if feeder_time is not None:
+        print(f'feeder cycle:  {args.feeds} feeds in {feeder_time * 1000:.1f}ms')
+        print(f'delivery:      {len(updates)} updates to {len(bot.client.rooms)} rooms '
+              f'in {delivery_time * 1000:.1f}ms')
+    print(f'memory:        python heap {current / 2**20:.1f}MiB '
+          f'(peak {peak / 2**20:.1f}MiB), '
+          f'max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--batches', type=int, default=20,
+                        help='amount of /sync batches with messages')
+    parser.add_argument('--events', type=int, default=20,
+                        help='messages per room in every batch')
+    parser.add_argument('--commands', type=float, default=0.2,
+                        help='share of the messages that are commands')
+    parser.add_argument('--links', type=float, default=0.1,
+                        help='share of the messages that contain a link')
+    parser.add_argument('--feeds', type=int, default=50,
+                        help='amount of feeds for the feeder cycle')
+    parser.add_argument('--page-size', type=int, default=100000,
+                        help='size of the link preview pages in bytes')
+    parser.add_argument('--send-rate', type=float, default=1000,
+                        help='outgoing messages per second allowed by the bot')
+    parser.add_argument('--send-delay', type=float, default=0.02,
+                        help='latency of the homeserver on sending a message, in seconds')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds to wait for all the replies')
+    parser.add_argument('--loglevel', default='CRITICAL',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,39 @@
-from nio import (ClientConfig, AsyncClient, SyncResponse, KeysQueryResponse)
+from nio import (ClientConfig, AsyncClient, SyncResponse, KeysQueryResponse,
+                 LoginResponse, WhoamiError)
 from nio.events.invite_events import InviteMemberEvent
 
 import asyncio
-import aiohttp
 
 import logbook
 import sys
 import glob
 import importlib.util
-import re
+import json
 import os
+import signal
 import time
+from functools import partial
+from types import SimpleNamespace
 
 from log import logger_group
 import config as cfg
 from command import Command
-from builtin import MessageLinksInfo, Feeder
+from builtin import MessageLinksInfo, Feeder, compose_updates
+from store import KVStore
+from httpclient import HTTPClient
+from sender import MessageSender
+from dispatcher import Dispatcher
+from router import Router
+from trust import TrustCache
+from metrics import MetricsServer
+from stallwatch import Watchdog
+from plugins import PluginIndex
+from shard import Channel, ShardPool, ShardSender
+import metrics
+
+
+sync_seconds = metrics.histogram('delator_sync_callback_seconds',
+                                 'Time spent in the sync response callback')
 
 
 class Bot:
@@ -24,9 +42,33 @@ class Bot:
     cfg = cfg
 
     sync_delay = 1000
-
-    def __init__(self, loglevel=None):
-        config = ClientConfig(encryption_enabled=True,
+    # only the events the bot handles are synced, members are loaded lazily
+    # so that neither the startup nor the memory scale with the room history;
+    # state changing events stay in the timeline to keep the rooms consistent
+    sync_filter = {
+        'presence': {'types': []},
+        'room': {
+            'state': {'lazy_load_members': True},
+            'timeline': {
+                'types': ['m.room.message', 'm.room.encrypted',
+                          'm.room.member', 'm.room.encryption'],
+                'limit': getattr(cfg, 'sync_timeline_limit', 20),
+                'lazy_load_members': True
+            },
+            'ephemeral': {'types': []},
+        },
+    }
+    # don't handle the events sent before the bot was started
+    skip_old_events = getattr(cfg, 'skip_old_events', True)
+    # default timeout in seconds for a command to finish
+    command_timeout = getattr(cfg, 'command_timeout', 60)
+    # time in seconds given to running handlers to finish on shutdown
+    shutdown_timeout = getattr(cfg, 'shutdown_timeout', 10)
+    # how often in seconds the commands directory is checked for changes
+    reload_interval = getattr(cfg, 'commands_reload_interval', 2)
+
+    def __init__(self, loglevel=None, watchdog=None, workers=0):
+        config = ClientConfig(encryption_enabled=getattr(cfg, 'encryption', True),
                               pickle_key=cfg.pickle_key,
                               store_name=cfg.store_name,
                               store_sync_tokens=True)
@@ -34,12 +76,6 @@ class Bot:
         if not os.path.exists(cfg.store_path):
             os.makedirs(cfg.store_path)
 
-        timeout = aiohttp.ClientTimeout(total=30)
-        self.http_session = aiohttp.ClientSession(
-            headers={'User-Agent': cfg.user_agent},
-            timeout=timeout
-        )
-
         self.client = AsyncClient(
             cfg.server,
             cfg.user,
@@ -48,22 +84,59 @@ class Bot:
             store_path=cfg.store_path
         )
 
+        self._setup_logging(loglevel, 'bot')
+
+        # milliseconds, to be compared with the timestamps of the events
+        self.started_at = int(time.time() * 1000)
+        # access token and the last sync token, kept between restarts
+        self.session_path = os.path.join(cfg.store_path, 'session.json')
+        self.sender = MessageSender(self.client)
+        self.trust = TrustCache(self.client)
+        # the first keys query goes through the whole device store,
+        # the following ones only through the devices that changed
+        self.devices_swept = False
+        self.metrics = MetricsServer()
+        # stall detector, enabled with a threshold in seconds
+        self.watchdog = Watchdog(watchdog) if watchdog else None
+        # commands and link previews are run by worker processes
+        self.shards = ShardPool(self, workers, loglevel) if workers else None
+        self._setup_handling()
+        self.feeder = Feeder(self.http)
+        self.client.add_response_callback(self._device_list_cb, SyncResponse)
+        self.client.add_response_callback(self._sync_cb, SyncResponse)
+        self.client.add_response_callback(
+            self._key_query_cb, KeysQueryResponse)
+        self.client.add_event_callback(self._invite_cb, InviteMemberEvent)
+
+    def _setup_handling(self):
+        # what it takes to handle events, in the sync process as well
+        # as in the worker processes
+        self.http = HTTPClient()
+        # kept for the commands that use the session directly
+        self.http_session = self.http.session
+        self.dispatcher = Dispatcher()
+        self.tasks = []
+        self.mli = MessageLinksInfo(self.http)
+
+        self.router = Router(getattr(cfg, 'command_prefixes', ('%',)),
+                             getattr(cfg, 'command_abbreviations', True))
+        self.plugins = PluginIndex(
+            os.path.join(cfg.store_path, 'commands_index.json'))
+        # file path -> mtime of the command modules seen so far
+        self.command_mtimes = {}
+        # persistent namespaces of the command storages
+        self.kv = KVStore(os.path.join(cfg.store_path, 'storage.db'),
+                          getattr(cfg, 'storage_flush_interval', 5))
+        self._register_commands()
+
+    def _setup_logging(self, loglevel, name):
         logger_group.level = getattr(
             logbook, loglevel) if loglevel else logbook.CRITICAL
         logbook.StreamHandler(sys.stdout).push_application()
 
-        self.logger = logbook.Logger('bot')
+        self.logger = logbook.Logger(name)
         logger_group.add_logger(self.logger)
 
-        self.mli = MessageLinksInfo(self.http_session)
-        self.feeder = Feeder()
-
-        self._register_commands()
-        self.client.add_response_callback(self._sync_cb, SyncResponse)
-        self.client.add_response_callback(
-            self._key_query_cb, KeysQueryResponse)
-        self.client.add_event_callback(self._invite_cb, InviteMemberEvent)
-
     def _preserve_name(self, path):
         return path.split('/')[-1].split('.py')[0].strip().replace(' ', '_').replace('-', '')
 
@@ -89,47 +162,107 @@ class Bot:
         help = module.help if hasattr(module, 'help') and \
             isinstance(module.help, str) else ''
 
-        return (name, handler, aliases, help)
+        timeout = module.timeout if hasattr(module, 'timeout') and \
+            isinstance(module.timeout, (int, float)) else self.command_timeout
+
+        return (name, handler, aliases, help, timeout)
+
+    def _is_main_process(self, module):
+        # the command needs the matrix client, the feeder or the state
+        # shared by all the rooms, so it can't run in a worker process
+        return getattr(module, 'main_process', False) is True
+
+    def _is_eager(self, module):
+        # the command serves something by itself, e.g. an http endpoint,
+        # so it can't wait for its first call to be loaded
+        return getattr(module, 'eager', False) is True
+
+    def _runs_here(self, command):
+        return not self.shards or command.main_process
+
+    async def _load_eager_commands(self):
+        for command in set(self.commands.values()):
+            if command.eager and self._runs_here(command):
+                try:
+                    await command.load()
+                except Exception as e:
+                    self.logger.critical(f'Unable to load command {command}: {e}')
+
+    def _load_module(self, name, file_path):
+        spec = importlib.util.spec_from_file_location(
+            name, file_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        if not self._validate_module(module):
+            name = module.name if hasattr(module, 'name') else name
+            raise ImportError(f'Unable to register command \'{name}\' '
+                              f'(\'{module.__file__}\'). '
+                              'Command module must contain a callable '
+                              'object with name \'handler\'.')
+        return module
+
+    def _make_command(self, file_path):
+        name = self._preserve_name(file_path)
+        manifest = self.plugins.manifest(file_path)
+        # older indexes may hold manifests without a handler
+        if manifest is None or not manifest['handler']:
+            # the module has to be run to find out what is inside
+            module = self._load_module(name, file_path)
+            name, _, aliases, help, timeout = self._process_module(module)
+            return Command(name, None, aliases, help, timeout, self,
+                           loader=lambda: module, file_path=file_path,
+                           main_process=self._is_main_process(module),
+                           eager=self._is_eager(module))
+
+        # the module itself is imported on the first call of the command
+        module = SimpleNamespace(__name__=name, **manifest)
+        name, _, aliases, help, timeout = self._process_module(module)
+        return Command(name, None, aliases, help, timeout, self,
+                       loader=partial(self._load_module, module.__name__, file_path),
+                       file_path=file_path,
+                       main_process=self._is_main_process(module),
+                       eager=self._is_eager(module))
+
+    def _command_files(self):
+        return [fn for fn in glob.glob(
+            "./commands/*.py") if not fn.count('__')]
+
+    def _add_command(self, commands, command, file_path):
+        if not commands.get(command.name):
+            commands[command.name] = command
+        else:
+            raise ImportError(
+                f'Unable to register command \'{command.name}\' '
+                f'(\'{file_path}\'). '
+                'A command with this name already exists.')
+
+        for alias in command.aliases:
+            if not commands.get(alias):
+                commands[alias] = command
+            else:
+                self.logger.warn(f'Unable to register alias \'{alias}\'! '
+                                 'An alias with this name already exists '
+                                 f'({commands[alias]}). Ignoring.')
+
+    def _save_plugins(self):
+        try:
+            self.plugins.save()
+        except OSError as e:
+            self.logger.error(f'Unable to save the commands index: {e}')
 
     def _register_commands(self):
-        files_to_import = [fn for fn in glob.glob(
-            "./commands/*.py") if not fn.count('__')]
-        for file_path in files_to_import:
+        for file_path in self._command_files():
+            self.command_mtimes[file_path] = os.path.getmtime(file_path)
             try:
-                name = self._preserve_name(file_path)
-                spec = importlib.util.spec_from_file_location(
-                    name, file_path)
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
-
-                name = module.name if hasattr(module, 'name') else name
-
-                if not self._validate_module(module):
-                    raise ImportError(f'Unable to register command \'{name}\' '
-                                      f'(\'{module.__file__}\'). '
-                                      'Command module must contain a callable '
-                                      'object with name \'handler\'.')
-
-                command = Command(
-                    *self._process_module(module), self)
-
-                if not self.commands.get(command.name):
-                    self.commands[command.name] = command
-                else:
-                    raise ImportError(
-                        f'Unable to register command \'{command.name}\' '
-                        f'(\'{module.__file__}\'). '
-                        'A command with this name already exists.')
-
-                for alias in command.aliases:
-                    if not self.commands.get(alias):
-                        self.commands[alias] = command
-                    else:
-                        self.logger.warn(f'Unable to register alias \'{alias}\'! '
-                                         'An alias with this name already exists '
-                                         f'({self.commands[alias]}). Ignoring.')
+                command = self._make_command(file_path)
+                self._add_command(self.commands, command, file_path)
             except Exception as e:
                 self.logger.critical(e)
+        self._save_plugins()
+
+        # the routing trie is only rebuilt when the commands change
+        self.router.build(self.commands)
 
         if self.commands:
             self.logger.info(
@@ -137,55 +270,201 @@ class Bot:
         else:
             self.logger.warn('No commands added!')
 
-    def _parse_command(self, message):
-        match = re.findall(r'^%([\w\d_]*)\s?(.*)$', message)
-        if match:
-            return (match[0][0], (match[0][1].split()))
-        else:
-            return (None, None)
+    async def _reload_commands(self):
+        files = self._command_files()
+        mtimes = {fn: os.path.getmtime(fn) for fn in files}
+        changed = [fn for fn in files if self.command_mtimes.get(fn) != mtimes[fn]]
+        removed = [fn for fn in self.command_mtimes if fn not in mtimes]
+        if not changed and not removed:
+            return
+
+        current = {c.file_path: c for c in set(self.commands.values())}
+        commands = dict(self.commands)
+        # (old command, new command) pairs
+        replaced = []
+        for file_path in removed + changed:
+            old = current.get(file_path)
+            new = None
+            if file_path in mtimes:
+                self.command_mtimes[file_path] = mtimes[file_path]
+                try:
+                    new = self._make_command(file_path)
+                except Exception as e:
+                    # the old version keeps working
+                    self.logger.critical(e)
+                    continue
+            else:
+                self.command_mtimes.pop(file_path)
+            if old:
+                commands = {n: c for n, c in commands.items() if c is not old}
+            if new:
+                if old:
+                    new.storage = old.storage
+                try:
+                    self._add_command(commands, new, file_path)
+                except ImportError as e:
+                    self.logger.critical(e)
+                    new = None
+            replaced.append((old, new))
+
+        # swap the commands at once, then let the old modules
+        # clean up and bring up the new ones of the running commands
+        self.commands = commands
+        self.router.build(commands)
+        self._save_plugins()
+        for old, new in replaced:
+            if old:
+                await old.unload()
+            if new and (old and old.module or new.eager and self._runs_here(new)):
+                await new.load()
+            self.logger.info(f'Reloaded command {new or old}' if new else
+                             f'Removed command {old}')
+
+    async def _watch_commands(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self._reload_commands()
+            except Exception as e:
+                self.logger.critical(f'Failed to reload commands: {e}')
 
     async def _serve_feeder(self):
         while True:
-            updates = self.feeder.get_updates()
+            updates = await self.feeder.get_updates()
             if len(updates):
-                update_start = time.time()
-                lines = [
-                    f'{u["url"]}\n<strong>{u["title"]}</strong>' for u in updates]
-                content = {
-                    'body': '\n'.join(lines),
-                    'msgtype': 'm.text',
-                    'format': 'org.matrix.custom.html'
-                }
-                content.update({
-                    'formatted_body': content['body']
-                })
-
-                for room_id in self.client.rooms:
-                    await self.client.room_send(room_id, 'm.room.message', content)
-                time_to_sleep = cfg.feeder_period - \
-                    (time.time() - update_start)
-                if time_to_sleep > 0:
-                    await asyncio.sleep(time_to_sleep)
-            else:
-                await asyncio.sleep(cfg.feeder_period)
+                self._deliver_updates(updates)
+            await self.feeder.wait()
+
+    def _deliver_updates(self, updates):
+        '''
+        Queues the updates for the rooms subscribed to their feeds and
+        returns the futures of the deliveries. The messages are composed
+        once per distinct set of updates, the sender serves the rooms
+        concurrently.
+        '''
+        futures = []
+        for room_ids, room_updates in self.feeder.fan_out(updates, set(self.client.rooms)):
+            for content in compose_updates(room_updates, self.sender.max_length):
+                futures += [self.sender.send(room_id, content) for room_id in room_ids]
+        return futures
+
+    def _load_session(self):
+        try:
+            with open(self.session_path) as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # the account has been changed in the configuration
+        if session.get('user_id') != cfg.user:
+            return None
+        return session
+
+    def _save_session(self):
+        session = {
+            'user_id': self.client.user_id,
+            'device_id': self.client.device_id,
+            'access_token': self.client.access_token,
+            'next_batch': self.client.next_batch or None
+        }
+        # the access token is as good as the password
+        tmp_path = self.session_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session, f)
+        os.replace(tmp_path, self.session_path)
+
+    async def _login(self):
+        '''
+        Restores the previous session if there is one and logs in with
+        the password otherwise. Returns the sync token to continue from.
+        '''
+        session = self._load_session()
+        if session:
+            self.client.restore_login(
+                session['user_id'], session['device_id'], session['access_token'])
+            response = await self.client.whoami()
+            if not isinstance(response, WhoamiError) or \
+                    response.status_code not in ('M_UNKNOWN_TOKEN', 'M_MISSING_TOKEN'):
+                self.logger.info(
+                    f'restored the session of device {session["device_id"]}')
+                # the store keeps the token of the latest sync when encryption
+                # is enabled, otherwise the one saved on shutdown is used
+                return self.client.loaded_sync_token or session.get('next_batch')
+            self.logger.warning(f'stored session is not valid anymore: {response}')
 
-    async def _serve_forever(self):
         response = await self.client.login(cfg.password)
         self.logger.info(response)
+        if isinstance(response, LoginResponse):
+            self._save_session()
+        return self.client.loaded_sync_token or None
+
+    async def _serve_forever(self):
+        if self.shards:
+            # the workers boot while logging in
+            self.shards.start()
+        since = await self._login()
+        await self._load_eager_commands()
+        await self.metrics.start()
+        if self.watchdog:
+            self.watchdog.start()
         feeder_task = asyncio.create_task(self._serve_feeder())
         sync_task = asyncio.create_task(
-            self.client.sync_forever(1000, full_state=True))
-        await asyncio.gather(feeder_task, sync_task)
+            self.client.sync_forever(self.sync_delay, sync_filter=self.sync_filter,
+                                     since=since))
+        self.tasks = [feeder_task, sync_task]
+        if self.reload_interval:
+            self.tasks.append(asyncio.create_task(self._watch_commands()))
+        try:
+            await asyncio.gather(*self.tasks)
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        self.logger.info('shutting down')
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.dispatcher.shutdown(self.shutdown_timeout)
+        if self.shards:
+            await self.shards.stop(self.shutdown_timeout)
+        await self.sender.drain(self.shutdown_timeout)
+        for command in set(self.commands.values()):
+            await command.unload()
+        self.kv.close()
+        self.mli.close()
+        self.feeder.close()
+        await self.metrics.stop()
+        if self.watchdog:
+            self.watchdog.stop()
+        if self.client.access_token:
+            self._save_session()
+        await self.http.close()
+        await self.client.close()
+
+    def _check_device(self, device):
+        if device.trust_state.value == 0:
+            if device.user_id in cfg.manager_accounts:
+                self.client.verify_device(device)
+                self.logger.info(
+                    f'Verified manager\'s device {device.device_id} for user {device.user_id}')
+            else:
+                self.client.blacklist_device(device)
 
     async def _key_query_cb(self, response):
-        for device in self.client.device_store:
-            if device.trust_state.value == 0:
-                if device.user_id in cfg.manager_accounts:
-                    self.client.verify_device(device)
-                    self.logger.info(
-                        f'Verified manager\'s device {device.device_id} for user {device.user_id}')
-                else:
-                    self.client.blacklist_device(device)
+        if not self.devices_swept:
+            for device in self.client.device_store:
+                self._check_device(device)
+            self.devices_swept = True
+            self.trust.clear()
+        else:
+            for devices in response.changed.values():
+                for device in devices.values():
+                    self._check_device(device)
+            self.trust.invalidate(response.changed)
+
+    async def _device_list_cb(self, response):
+        self.trust.invalidate(response.device_list.changed)
+        self.trust.invalidate(response.device_list.left)
 
     async def _invite_cb(self, room, event):
         if room.room_id not in self.client.rooms and \
@@ -195,9 +474,7 @@ class Bot:
                 f'Accepted invite to room {room.room_id} from {event.sender}')
 
     def _is_sender_verified(self, sender):
-        devices = [
-            d for d in self.client.device_store.active_user_devices(sender)]
-        return all(map(lambda d: d.trust_state.value == 1, devices))
+        return self.trust.is_verified(sender)
 
     async def _process_links(self, message, room_id):
         info = await self.mli._get_info(message)
@@ -209,23 +486,110 @@ class Bot:
                 'format': 'org.matrix.custom.html',
                 'msgtype': 'm.text'
             }
-            await self.client.room_send(room_id, 'm.room.message', content)
+            self.sender.send(room_id, content)
 
     async def _sync_cb(self, response):
-        if len(response.rooms.join) > 0:
-            joins = response.rooms.join
-            for room_id in joins:
-                for event in joins[room_id].timeline.events:
-                    if self._is_sender_verified(event.sender) and hasattr(event, 'body'):
-                        command, args = self._parse_command(event.body)
-                        if command and command in self.commands:
-                            await self.commands[command].run(
-                                args, event, room_id)
-                            self.logger.debug(
-                                f'serving command \'{command}\' with arguments {args} in room {room_id}')
-                        if event.sender != self.cfg.user:
-                            await self._process_links(event.body, room_id)
+        # handlers run in the dispatcher, the sync loop never waits for them;
+        # commands and link previews are ordered within a room
+        with sync_seconds.time():
+            if len(response.rooms.join) > 0:
+                joins = response.rooms.join
+                for room_id in joins:
+                    for event in joins[room_id].timeline.events:
+                        if self.skip_old_events and \
+                                event.server_timestamp < self.started_at:
+                            continue
+                        if self._is_sender_verified(event.sender) and hasattr(event, 'body'):
+                            route = self.router.route(event.body)
+                            if self.shards and not (route and route[0].main_process):
+                                self.shards.submit(room_id, event)
+                            else:
+                                self._handle_event(room_id, event, route)
+
+    def _handle_event(self, room_id, event, route):
+        if route:
+            command, args, text = route
+            self.dispatcher.submit(
+                (room_id, 'commands'),
+                partial(command.run, args, event, room_id, text),
+                timeout=command.timeout, name=f'%{command.name}')
+            self.logger.debug(
+                f'serving command \'{command.name}\' with arguments {args} in room {room_id}')
+        if event.sender != self.cfg.user:
+            self.dispatcher.submit(
+                (room_id, 'links'),
+                partial(self._process_links, event.body, room_id),
+                name='link preview')
 
     def serve(self):
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._serve_forever())
+        main_task = loop.create_task(self._serve_forever())
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, main_task.cancel)
+        try:
+            loop.run_until_complete(main_task)
+        except asyncio.CancelledError:
+            pass
+
+
+class WorkerBot(Bot):
+    '''
+    Worker process of the sharded mode. Runs the commands and link previews
+    of the events forwarded by the sync process, which also sends the
+    replies. There's no matrix client here, so the commands that need one
+    are marked with `main_process` and never get here.
+    '''
+
+    def __init__(self, index, conn, loglevel=None):
+        self.index = index
+        self._setup_logging(loglevel, f'worker-{index}')
+
+        self.channel = Channel(conn, self._receive)
+        self.sender = ShardSender(self.channel)
+        self.stopping = asyncio.Event()
+        self.watchdog = None
+        self.shards = None
+        self._setup_handling()
+
+    def _receive(self, message):
+        if message is None or message[0] == 'stop':
+            self.stopping.set()
+        elif message[0] == 'event':
+            _, room_id, event = message
+            event = SimpleNamespace(**event)
+            route = self.router.route(event.body)
+            if route and route[0].main_process:
+                route = None
+            self._handle_event(room_id, event, route)
+        elif message[0] == 'sent':
+            self.sender.resolve(*message[1:])
+
+    def _runs_here(self, command):
+        return not command.main_process
+
+    async def _serve_forever(self):
+        self.channel.start()
+        await self._load_eager_commands()
+        if self.reload_interval:
+            self.tasks.append(asyncio.create_task(self._watch_commands()))
+        try:
+            await self.stopping.wait()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        self.logger.info('shutting down')
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.dispatcher.shutdown(self.shutdown_timeout)
+        await self.sender.drain(self.shutdown_timeout)
+        for command in set(self.commands.values()):
+            await command.unload()
+        self.kv.close()
+        self.mli.close()
+        await self.http.close()
+        self.channel.close()
+
+    def serve(self):
+        asyncio.get_event_loop().run_until_complete(self._serve_forever())
@@ -8,12 +8,71 @@ import logbook
 from log import logger_group
 
 import re
-import gzip
+import html
+import codecs
 import json
 import os
 import time
+import heapq
+import random
+import calendar
+import hashlib
+import threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from collections import namedtuple
+from functools import partial
+from urllib.parse import urlparse, urlunparse
 
 import config as cfg
+from cache import TTLCache
+from store import FeedStore
+import metrics
+
+
+link_stage_seconds = metrics.histogram('delator_link_stage_seconds',
+                                       'Time taken by the stages of a link preview', ('stage',))
+link_preview_seconds = metrics.histogram('delator_link_preview_seconds',
+                                         'Time taken by a link preview, excluding cache hits')
+link_cache = metrics.gauge('delator_link_cache', 'Link preview cache statistics', ('stat',))
+feeder_cycle_seconds = metrics.histogram('delator_feeder_cycle_seconds',
+                                         'Time taken by a feeder cycle')
+feed_fetch_seconds = metrics.histogram('delator_feed_fetch_seconds',
+                                       'Time taken by polling a feed', ('feed',))
+feed_errors = metrics.counter('delator_feed_errors_total', 'Failed feed polls')
+
+
+class StageTimer:
+    '''
+    Sums up the spans of a link preview stage that are interleaved with
+    other stages, the total is observed once.
+    '''
+
+    def __init__(self, stage):
+        self.histogram = link_stage_seconds.labels(stage)
+        self.elapsed = 0
+
+    @contextmanager
+    def span(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    async def iterate(self, iterator):
+        # yields the items of an async iterator, timing only the waits
+        while True:
+            with self.span():
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield item
+
+    def observe(self):
+        self.histogram.observe(self.elapsed)
 
 
 class CustomLogger:
@@ -27,99 +86,312 @@ class CustomLogger:
         pass
 
 
-class MessageLinksInfo:
-    chunk_size = 100000
-    codecs = ['utf8', 'koi8-r', 'cp1251']
+# youtube_dl instances are not thread-safe, so every executor worker
+# (thread or process) lazily creates its own one
+_ytdl_local = threading.local()
 
-    def __init__(self, session):
-        self.session = session
-        self.magic = magic.Magic(mime=True, uncompress=True)
-        self.ytdl = youtube_dl.YoutubeDL({
+
+def _ytdl_extract_title(url):
+    ytdl = getattr(_ytdl_local, 'ytdl', None)
+    if ytdl is None:
+        ytdl = _ytdl_local.ytdl = youtube_dl.YoutubeDL({
             'skip_download': True,
             'source_address': cfg.ytdl_source_address if hasattr(cfg, 'ytdl_source_address') else None,
             'logger': CustomLogger()
         })
+    try:
+        extracted = ytdl.extract_info(url)
+        return extracted['title']
+    except Exception:
+        return None
+
+
+class TitleReader:
+    '''
+    Collects an html document chunk by chunk until its <title> is closed,
+    so that the rest of the document does not have to be downloaded.
+    '''
+    prefix_size = 4096
+    confidence_threshold = 0.5
+    fallback_codecs = ['utf8', 'koi8-r', 'cp1251']
+
+    title_regex = re.compile(rb'<title[^>]*>(.*?)</title\s*>', re.I | re.S)
+    title_end_regex = re.compile(rb'</title\s*>', re.I)
+    charset_regex = re.compile(
+        rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+
+    def __init__(self, charset=None):
+        self.buffer = bytearray()
+        self.charset = charset
+        self.closed = False
+        self._scanned = 0
+
+    def feed(self, data):
+        self.buffer += data
+        # step back a little in case the closing tag is split between chunks
+        start = max(self._scanned - 16, 0)
+        self._scanned = len(self.buffer)
+        if self.title_end_regex.search(self.buffer, start):
+            self.closed = True
+        return self.closed
+
+    def _valid_codec(self, name):
+        try:
+            codecs.lookup(name)
+            return True
+        except (LookupError, TypeError):
+            return False
+
+    def _detect_charset(self):
+        if self.charset and self._valid_codec(self.charset):
+            return self.charset
+        prefix = bytes(self.buffer[:self.prefix_size])
+        match = self.charset_regex.search(prefix)
+        if match:
+            charset = match.group(1).decode('ascii', errors='ignore')
+            if self._valid_codec(charset):
+                return charset
+        with link_stage_seconds.labels('chardet').time():
+            detected = chardet.detect(prefix)
+        if detected and detected['encoding'] and \
+                detected['confidence'] >= self.confidence_threshold:
+            return detected['encoding']
+        return None
+
+    def _decode(self, data):
+        charset = self._detect_charset()
+        for codec in ([charset] if charset else []) + self.fallback_codecs:
+            try:
+                return data.decode(codec)
+            except (UnicodeDecodeError, LookupError):
+                continue
+        return data.decode(self.fallback_codecs[0], errors='ignore')
 
-    def _parse_urls(self, message):
-        regex = r'http[s]?:\/\/(?:[a-zA-Z]|[0-9]|[$-_~@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-        match = re.findall(regex, message)
-        return match
+    def title(self):
+        match = self.title_regex.search(self.buffer)
+        return self._decode(match.group(1)).strip() if match else None
 
-    def _decompress(self, data):
-        try:
-            return gzip.decompress(data)
 
-        except (OSError, EOFError):
-            return None
+# what is known about a link that is not an html page, size may be None
+FileInfo = namedtuple('FileInfo', ('type', 'size'))
 
-    def _parse_title(self, html):
-        threshold = 0.5
-        detected = chardet.detect(html)
-        if detected and detected['confidence'] >= threshold:
-            decoded = html.decode(detected['encoding'], errors='ignore')
-        else:
-            # fallback method
-            for codec in self.codecs:
-                try:
-                    decoded = html.decode(codec, errors='ignore')
-                    break
-                except Exception as e:
-                    decoded = e
-
-        if not isinstance(decoded, str):
-            return decoded
-        regex = r'<title[\s\S^<]*>([\s\S]*)<\/title>'
-        match = re.findall(regex, decoded, re.IGNORECASE)
-        return match[0] if match else match
-
-    async def _fetch(self, session, urls):
-        entities = []
-        for url in urls:
-            title = self._ytdl_extract_title(url)
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024
+    return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+
+
+def normalize_url(url):
+    parsed = urlparse(url)
+    netloc = parsed.netloc.lower()
+    default_port = {'http': ':80', 'https': ':443'}.get(parsed.scheme.lower())
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return urlunparse((parsed.scheme.lower(), netloc, parsed.path or '/',
+                       parsed.params, parsed.query, ''))
+
+
+class MessageLinksInfo:
+    chunk_size = 100000
+    # amount of bytes libmagic gets to identify a file without a content type
+    sniff_size = 4096
+    html_types = {'text/html', 'application/xhtml+xml'}
+    # content types that don't tell anything, the body is sniffed instead
+    generic_types = {'application/octet-stream', 'binary/octet-stream',
+                     'application/unknown', 'text/plain'}
+    url_regex = re.compile(
+        r'http[s]?:\/\/(?:[a-zA-Z]|[0-9]|[$-_~@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+    # concurrency limits for link previews, shared across all messages
+    max_concurrency = getattr(cfg, 'links_max_concurrency', 16)
+    per_host_concurrency = getattr(cfg, 'links_per_host_concurrency', 2)
+    # deadline for a single url, including the time spent waiting for a slot
+    url_timeout = getattr(cfg, 'links_url_timeout', 20)
+
+    # youtube_dl runs off the event loop in a 'thread' or 'process' pool
+    ytdl_executor = getattr(cfg, 'ytdl_executor', 'thread')
+    ytdl_workers = getattr(cfg, 'ytdl_workers', 2)
+    ytdl_timeout = getattr(cfg, 'ytdl_timeout', 15)
+
+    # results are cached by normalized url, failures for a shorter time
+    cache_size = getattr(cfg, 'links_cache_size', 4096)
+    cache_ttl = getattr(cfg, 'links_cache_ttl', 3600)
+    cache_negative_ttl = getattr(cfg, 'links_cache_negative_ttl', 300)
+    cache_persist = getattr(cfg, 'links_cache_persist', False)
+
+    def __init__(self, http):
+        # httpclient.HTTPClient
+        self.http = http
+        self.logger = logbook.Logger('links')
+        logger_group.add_logger(self.logger)
+
+        self.cache = TTLCache(
+            max_size=self.cache_size,
+            ttl=self.cache_ttl,
+            negative_ttl=self.cache_negative_ttl,
+            path=os.path.join(cfg.store_path, 'links_cache.json') if self.cache_persist else None
+        )
+        for stat in self.cache.stats():
+            link_cache.labels(stat).set_function(
+                partial(lambda stat: self.cache.stats()[stat], stat))
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        # host -> [semaphore, number of users], dropped once unused
+        self.host_slots = {}
+        # only a prefix is sniffed, so compressed files can't be looked into
+        self.magic = magic.Magic(mime=True)
+
+        executor = ProcessPoolExecutor if self.ytdl_executor == 'process' \
+            else ThreadPoolExecutor
+        self.executor = executor(max_workers=self.ytdl_workers)
+        # the generic extractor matches any url and then downloads the page
+        # once again, plain pages are handled by our own fetcher instead
+        self.extractors = [ie for ie in youtube_dl.extractor.gen_extractor_classes()
+                           if ie.ie_key() != 'Generic']
+
+    def _parse_urls(self, message):
+        if 'http' not in message:
+            return []
+        return self.url_regex.findall(message)
+
+    @asynccontextmanager
+    async def _slot(self, url):
+        host = urlparse(url).hostname or ''
+        slot = self.host_slots.get(host)
+        if slot is None:
+            slot = self.host_slots[host] = [
+                asyncio.Semaphore(self.per_host_concurrency), 0]
+        slot[1] += 1
+        try:
+            # take the per-host slot first so that a busy host
+            # does not hold global slots while waiting
+            async with slot[0]:
+                async with self.semaphore:
+                    yield
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                self.host_slots.pop(host, None)
+
+    async def _fetch_url(self, url):
+        async with self._slot(url):
+            title = await self._ytdl_extract_title(url)
             if title:
-                entities.append(title)
-            else:
-                try:
-                    async with session.get(url, proxy=cfg.proxy if hasattr(cfg, 'proxy') else None) as response:
-                        chunk = await response.content.readany()
-                        while hasattr(response.connection, 'closed') and \
-                                not response.connection.closed and \
-                                len(chunk) < self.chunk_size:
-                            chunk += await response.content.readany()
-                        entities.append(chunk)
-                except Exception as e:
-                    entities.append(e)
-        return entities
-
-    def _ytdl_extract_title(self, url):
+                return title
+            return await self._fetch_page(url)
+
+    async def _fetch_page(self, url):
+        '''
+        Returns the title of an html page, FileInfo of anything else.
+        Only html pages are downloaded (up to their title), other files
+        are identified by their content type or by their first bytes.
+        '''
+        # only the time spent waiting for the network counts as 'http',
+        # sniffing and decoding are stages of their own
+        http_timer = StageTimer('http')
+        try:
+            async with AsyncExitStack() as stack:
+                with http_timer.span():
+                    response = await stack.enter_async_context(self.http.get(url))
+                size = response.content_length
+                declared = response.content_type \
+                    if 'Content-Type' in response.headers else None
+                if declared and declared not in self.html_types | self.generic_types:
+                    # the headers say enough, the body is not downloaded
+                    return FileInfo(declared, size)
+
+                chunks = http_timer.iterate(response.content.iter_any())
+                reader = TitleReader(response.charset)
+                if declared not in self.html_types:
+                    prefix = await self._read_prefix(chunks)
+                    if len(prefix) < self.sniff_size:
+                        size = len(prefix)
+                    with link_stage_seconds.labels('magic').time():
+                        sniffed = self.magic.from_buffer(prefix)
+                    if sniffed not in self.html_types and \
+                            not sniffed.startswith('text/'):
+                        return FileInfo(sniffed, size)
+                    reader.feed(prefix)
+
+                if not reader.closed:
+                    async for data in chunks:
+                        if reader.feed(data) or len(reader.buffer) >= self.chunk_size:
+                            break
+                title = reader.title()
+                if title is not None:
+                    return title
+                return FileInfo(declared if declared in self.html_types
+                                else sniffed, size)
+        finally:
+            http_timer.observe()
+
+    async def _read_prefix(self, chunks):
+        prefix = bytearray()
+        async for data in chunks:
+            prefix += data
+            if len(prefix) >= self.sniff_size:
+                break
+        return bytes(prefix)
+
+    async def _fetch_one(self, url):
         try:
-            extracted = self.ytdl.extract_info(url)
-            return extracted['title']
+            return await asyncio.wait_for(self._fetch_url(url),
+                                          self.url_timeout)
+        except asyncio.TimeoutError:
+            return asyncio.TimeoutError(f'no response in {self.url_timeout}s')
+        except Exception as e:
+            return e
+
+    def _ytdl_suitable(self, url):
+        return any(ie.suitable(url) for ie in self.extractors)
+
+    async def _ytdl_extract_title(self, url):
+        if not self._ytdl_suitable(url):
+            return None
+        loop = asyncio.get_event_loop()
+        job = loop.run_in_executor(self.executor, _ytdl_extract_title, url)
+        try:
+            # on timeout the job is cancelled if it has not started yet,
+            # a running one is abandoned and its result is dropped
+            with link_stage_seconds.labels('ytdl').time():
+                return await asyncio.wait_for(job, self.ytdl_timeout)
         except Exception:
             return None
 
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self.cache.path:
+            self.cache.dump()
+
+    def _describe(self, entity):
+        # returns a line of info and whether it is a failure
+        if isinstance(entity, str):
+            return (f'Title: {entity}', False)
+        elif isinstance(entity, FileInfo):
+            if entity.size is None:
+                return (f'File type: {entity.type}', False)
+            return (f'File type: {entity.type}, size: {format_size(entity.size)}', False)
+        else:
+            return (f'Bad link: {repr(entity)}', True)
+
+    async def _url_info(self, url):
+        with link_preview_seconds.time():
+            entity = await self._fetch_one(url)
+            return self._describe(entity)
+
+    async def _get_url_info(self, url):
+        return await self.cache.get_or_fetch(normalize_url(url),
+                                             lambda: self._url_info(url))
+
     async def _get_info(self, message):
         urls = self._parse_urls(message)
-        entities = None
         if urls:
-            entities = await self._fetch(self.session, urls)
-        if entities:
-            info = []
-            for entity in entities:
-                if isinstance(entity, str):
-                    info.append(f'Title: {entity}')
-                elif isinstance(entity, bytes):
-                    dcomp = self._decompress(entity)
-                    entity = dcomp if dcomp else entity
-
-                    title = self._parse_title(entity)
-                    if isinstance(title, str):
-                        info.append(f'Title: {title}')
-                    else:
-                        file_type = self.magic.from_buffer(entity)
-                        info.append(f'File type: {file_type}')
-                else:
-                    info.append(f'Bad link: {repr(entity)}')
+            # gather() keeps the results in the same order as urls
+            info = await asyncio.gather(
+                *(self._get_url_info(url) for url in urls))
+            self.logger.debug(f'cache: {self.cache.stats()}')
             return info
 
     def get_info(self, message):
@@ -128,104 +400,406 @@ class MessageLinksInfo:
 
 
 class Feed:
-    def __init__(self, url):
+    # polling interval bounds, the actual interval adapts to the feed
+    period = getattr(cfg, 'feeder_period', 1800)
+    min_period = getattr(cfg, 'feeder_min_period', 300)
+    max_period = getattr(cfg, 'feeder_max_period', 86400)
+    jitter = getattr(cfg, 'feeder_jitter', 0.1)
+
+    # how many of the latest entries are used to estimate the publish rate
+    rate_window = 10
+    update_periods = {
+        'hourly': 3600,
+        'daily': 86400,
+        'weekly': 604800,
+        'monthly': 2592000,
+        'yearly': 31536000
+    }
+    max_age_regex = re.compile(r'max-age\s*=\s*(\d+)')
+
+    # amount of hashes of seen entries to remember per feed
+    seen_limit = getattr(cfg, 'feeder_seen_limit', 1000)
+
+    def __init__(self, url, state=None):
+        state = state or {}
         self.url = url
-        feed = feedparser.parse(url)
+        # validators of the last response, sent back as a conditional GET
+        self.etag = state.get('etag')
+        self.modified = state.get('modified')
+        self.fetched = False
+        self.last_poll = state.get('last_poll')
+
+        # hashes of the seen entries in the order they were seen
+        self.seen = dict.fromkeys(state.get('seen', []))
+        # rooms subscribed to the feed, updates of a feed nobody has
+        # subscribed to go to every room
+        self.rooms = set(state.get('rooms', []))
+        # (hash, timestamp) pairs not yet written to the store
+        self.unsaved_seen = []
+
+        # scheduling state
+        self.next_poll = state.get('next_poll') or time.time()
+        self.errors = state.get('errors', 0)
+        self.publish_interval = None  # estimated from the entries
+        self.hint = 0  # lower bound advertised by the feed itself
+        self.max_age = 0  # lower bound from Cache-Control
+        self.retry_after = 0  # lower bound from Retry-After
+
+        # until the first fetch, only the stored metadata is available
+        metadata = feedparser.FeedParserDict()
+        if state.get('title') is not None:
+            metadata.title = state['title']
+            metadata.link = state.get('link') or url
+        feed = feedparser.FeedParserDict(
+            feed=metadata, entries=[], href=url, bozo=0)
+        feed.error = None if 'title' in metadata else 'not fetched yet'
+        self.feed = feed
+
+    async def fetch(self, http):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.modified:
+            headers['If-Modified-Since'] = self.modified
+
+        async with http.get(self.url, headers=headers) as response:
+            self._read_cache_headers(response.headers)
+            if response.status == 304:
+                return None
+            response.raise_for_status()
+            body = await http.read(response)
+            # the lookup is only case-insensitive on the original headers
+            etag = response.headers.get('ETag')
+            modified = response.headers.get('Last-Modified')
+            response_headers = dict(response.headers)
+
+        self.etag = etag
+        self.modified = modified
+
+        loop = asyncio.get_event_loop()
+        feed = await loop.run_in_executor(
+            None, partial(feedparser.parse, body,
+                          response_headers=response_headers))
+        feed.href = self.url
         feed.error = f'{feed.bozo_exception}' if feed.bozo else None
         self.feed = feed
-        self.last_update = time.localtime()
+        self.fetched = True
+        self.hint = self._feed_hint(feed)
+        self.publish_interval = self._publish_interval(feed)
+        return feed
+
+    def _read_cache_headers(self, headers):
+        match = self.max_age_regex.search(headers.get('Cache-Control', ''))
+        self.max_age = int(match.group(1)) if match else 0
+        retry_after = headers.get('Retry-After')
+        self.retry_after = 0
+        if retry_after:
+            try:
+                self.retry_after = int(retry_after)
+            except ValueError:
+                try:
+                    self.retry_after = parsedate_to_datetime(
+                        retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
 
-    def get_update(self):
+    def _feed_hint(self, feed):
+        hint = 0
+        try:
+            # <ttl> is in minutes
+            hint = int(feed.feed.get('ttl', 0)) * 60
+        except (TypeError, ValueError):
+            pass
+        period = self.update_periods.get(
+            feed.feed.get('sy_updateperiod', '').strip().lower())
+        if period:
+            try:
+                frequency = max(int(feed.feed.get('sy_updatefrequency', 1)), 1)
+            except (TypeError, ValueError):
+                frequency = 1
+            hint = max(hint, period / frequency)
+        return hint
+
+    def _publish_interval(self, feed):
+        stamps = []
+        for entry in feed.entries:
+            parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+            if parsed:
+                stamps.append(calendar.timegm(parsed))
+        stamps = sorted(stamps)[-self.rate_window:]
+        if len(stamps) < 2:
+            return None
+        gap = (stamps[-1] - stamps[0]) / (len(stamps) - 1)
+        # a feed that has gone quiet is polled less often
+        gap = max(gap, (time.time() - stamps[-1]) / 2)
+        # poll about twice per expected entry
+        return gap / 2
+
+    def reschedule(self, failed=False):
+        self.errors = self.errors + 1 if failed else 0
+        if self.errors:
+            interval = self.period * 2 ** min(self.errors, 16)
+        else:
+            interval = self.publish_interval or self.period
+            interval = max(interval, self.hint, self.max_age)
+        interval = min(max(interval, self.min_period), self.max_period)
+        # Retry-After is the server's explicit demand, so it is never capped
+        interval = max(interval, self.retry_after)
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        self.next_poll = time.time() + interval
+        return self.next_poll
+
+    async def poll(self, http):
+        feed = await self.fetch(http)
+        return self.get_update(feed) if feed is not None else []
+
+    def _entry_hash(self, entry):
+        guid = entry.get('id') or entry.get('link') or entry.get('title', '')
+        return hashlib.sha1(guid.encode('utf8')).hexdigest()[:16]
+
+    def seen_capacity(self):
+        # the limit must exceed the size of the feed document itself,
+        # otherwise old entries would be seen as new ones again
+        return max(self.seen_limit, 2 * len(self.feed.entries))
+
+    def _remember(self, digest, seen_at):
+        self.seen[digest] = None
+        self.unsaved_seen.append((digest, seen_at))
+        limit = self.seen_capacity()
+        while len(self.seen) > limit:
+            del self.seen[next(iter(self.seen))]
+
+    def get_update(self, feed):
         update = []
-        feed = feedparser.parse(self.url)
+        now = time.time()
         for entry in feed.entries if hasattr(feed, "entries") else []:
-            if hasattr(entry, 'published_parsed'):
-                to_compare_with = entry.published_parsed
-            elif hasattr(entry, 'updated_parsed'):
-                to_compare_with = entry.updated_parsed
-            else:
-                to_compare_with = time.gmtime(0)
-
-            if to_compare_with > self.last_update:
+            digest = self._entry_hash(entry)
+            if digest in self.seen:
+                continue
+            self._remember(digest, now)
+            # entries that are there at the very first poll are not news
+            if self.last_poll is not None:
                 update.append({
-                    'title': entry.title,
-                    'url': entry.link
+                    'feed': self.url,
+                    'title': entry.get('title', ''),
+                    'url': entry.get('link', '')
                 })
-                self.last_update = to_compare_with
+        self.last_poll = now
         return update
 
 
+def compose_updates(updates, max_length):
+    '''
+    Turns feed updates into messages with formatted bodies of at most
+    max_length characters. An update is never split between two messages.
+    '''
+    messages = []
+    lines, formatted = [], []
+    length = 0
+    for update in updates:
+        line = f'{update["url"]}\n{update["title"]}'
+        formatted_line = f'{html.escape(update["url"])}<br>' \
+            f'<strong>{html.escape(update["title"])}</strong>'
+        if formatted and length + len(formatted_line) + 4 > max_length:
+            messages.append((lines, formatted))
+            lines, formatted = [], []
+            length = 0
+        lines.append(line)
+        formatted.append(formatted_line)
+        length += len(formatted_line) + 4
+    if formatted:
+        messages.append((lines, formatted))
+    return [{
+        'body': '\n'.join(lines),
+        'msgtype': 'm.text',
+        'format': 'org.matrix.custom.html',
+        'formatted_body': '<br>'.join(formatted)
+    } for lines, formatted in messages]
+
+
 class Feeder:
-    def __init__(self):
+    # amount of feeds being fetched simultaneously
+    concurrency = getattr(cfg, 'feeder_concurrency', 16)
+
+    def __init__(self, http):
+        self.http = http
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        # heap of (next poll time, url), entries that do not match
+        # the current state of a feed are stale and skipped
+        self.schedule = []
+        self.changed = asyncio.Event()
+
         self.logger = logbook.Logger('feeder')
         logger_group.add_logger(self.logger)
 
-        self.urls_file = os.path.join(cfg.store_path, 'feeds.json')
-        urls_dump = self._load_urls()
-        urls_dump = list(set(urls_dump)) if urls_dump is not None else []
+        self.store = FeedStore(os.path.join(cfg.store_path, 'feeds.db'))
         self.feeds = {}
 
-        if not urls_dump:
-            self._dump_urls()
-        else:
-            for url in urls_dump:
-                error = self.add_feed(url)
-                if error:
-                    self.logger.error(
-                        f'Unable to add a feed with url "{url}": {error}')
-                else:
-                    feed = self.feeds[url].feed
-                    message = f'loaded up feed {feed.href}'
-                    message += f' with title "{feed.feed.title}"' if hasattr(feed.feed, 'title') else \
-                               f' ({feed.error})'
-                    self.logger.info(message)
-
-    def _load_urls(self):
-        if os.path.exists(self.urls_file):
-            try:
-                urls = json.load(open(self.urls_file))
-                if not isinstance(urls, list):
-                    self.logger.error(f'{self.urls_file}: wrong format')
-                    return None
-                if len(urls):
-                    for url in urls:
-                        if not isinstance(url, str):
-                            self.logger.error(
-                                f'{self.urls_file}: url must be str, not {type(url)}')
-                            return None
-                return urls
-            except Exception as error:
-                self.logger.error(f'{self.urls_file}: {error}')
-                return None
-        else:
-            self.logger.warning(f'{self.urls_file}: file does not exist,'
-                                ' assuming there are no feeds added to the bot')
-            return None
-
-    def _dump_urls(self):
-        json.dump(list(self.feeds.keys()), open(self.urls_file, 'w'))
-
-    def add_feed(self, url):
-        if url in self.feeds:
-            return 'This feed is already on the list.'
+        # feeds are restored from the store, they are fetched
+        # for the first time when they are due
+        for url, state in self.store.load().items():
+            self.feeds[url] = Feed(url, state)
+            self._schedule(self.feeds[url])
+        if not self.feeds:
+            self._migrate_urls()
+        self.logger.info(f'loaded {len(self.feeds)} feeds')
+
+    def _migrate_urls(self):
+        # the list of feeds used to be kept in feeds.json
+        urls_file = os.path.join(cfg.store_path, 'feeds.json')
+        if not os.path.exists(urls_file):
+            return
+        try:
+            with open(urls_file) as f:
+                urls = json.load(f)
+            if not isinstance(urls, list) or \
+                    not all(isinstance(url, str) for url in urls):
+                self.logger.error(f'{urls_file}: wrong format')
+                return
+        except Exception as error:
+            self.logger.error(f'{urls_file}: {error}')
+            return
+        for url in set(urls):
+            self.feeds[url] = Feed(url)
+            self.store.save_feed(self.feeds[url])
+            self._schedule(self.feeds[url])
+        self.store.commit()
+        os.replace(urls_file, f'{urls_file}.bak')
+        self.logger.info(f'{urls_file}: migrated {len(urls)} feeds to the store')
+
+    def room_feeds(self, room_id):
+        # the feeds whose updates are posted to the room
+        return [feed for feed in self.feeds.values()
+                if not feed.rooms or room_id in feed.rooms]
+
+    async def add_feed(self, url, room_id=None):
+        '''
+        Subscribes the room to the feed, without room_id the feed is posted
+        to every room.
+        '''
+        feed = self.feeds.get(url)
+        if feed is not None:
+            if room_id is None or not feed.rooms or room_id in feed.rooms:
+                return 'This feed is already on the list.'
+            feed.rooms.add(room_id)
+            self.store.subscribe(url, room_id)
+            await self.store.flush()
+            return
         feed = Feed(url)
+        if room_id is not None:
+            feed.rooms.add(room_id)
+            self.store.subscribe(url, room_id)
         self.feeds[url] = feed
-        self._dump_urls()
-
-    def del_feed(self, url):
-        if url in self.feeds:
-            self.feeds.pop(url)
-            self._dump_urls()
-        else:
+        await self._poll(feed)
+        await self.store.flush()
+        self.changed.set()
+
+    async def del_feed(self, url, room_id=None):
+        '''
+        Unsubscribes the room from the feed, the feed itself is deleted along
+        with its last subscription. A feed posted to every room, as well as
+        any feed when room_id is None, is deleted right away.
+        '''
+        feed = self.feeds.get(url)
+        if feed is None or \
+                (room_id is not None and feed.rooms and room_id not in feed.rooms):
             return 'This feed is not on the list.'
-
-    def get_updates(self):
-        updates = []
-        for feed in self.feeds.values():
-            # Apparetnly we can get an exception raised out of the
-            # feedparser.parse() function, so let's check
+        if room_id is not None and len(feed.rooms) > 1:
+            feed.rooms.discard(room_id)
+            self.store.unsubscribe(url, room_id)
+        else:
+            self.feeds.pop(url)
+            self.store.delete_feed(url)
+            feed_fetch_seconds.remove(url)
+            # in case the feed is added again before the flush
+            for room in feed.rooms:
+                self.store.unsubscribe(url, room)
+        await self.store.flush()
+
+    def fan_out(self, updates, rooms):
+        '''
+        Groups updates by the rooms they are posted to. Returns a list of
+        (room ids, updates) pairs, the rooms that receive the same updates
+        share a pair.
+        '''
+        # room_id -> indices of its updates
+        by_room = {}
+        for index, update in enumerate(updates):
+            feed = self.feeds.get(update['feed'])
+            if feed is None:
+                # deleted while it was polled
+                continue
+            for room_id in feed.rooms & rooms if feed.rooms else rooms:
+                by_room.setdefault(room_id, []).append(index)
+        groups = {}
+        for room_id, indices in by_room.items():
+            groups.setdefault(tuple(indices), []).append(room_id)
+        return [(room_ids, [updates[index] for index in indices])
+                for indices, room_ids in groups.items()]
+
+    def _log_loaded(self, feed):
+        message = f'loaded up feed {feed.url}'
+        message += f' with title "{feed.feed.feed.title}"' if hasattr(feed.feed.feed, 'title') else \
+                   f' ({feed.feed.error})'
+        self.logger.info(message)
+
+    async def _poll(self, feed):
+        async with self.semaphore:
+            fetched = feed.fetched
             try:
-                updates += feed.get_update()
+                with feed_fetch_seconds.labels(feed.url).time():
+                    update = await feed.poll(self.http)
             except Exception as error:
+                feed_errors.inc()
                 self.logger.error(f'Failed to get an update for feed url {feed.url}: {error}')
-        return updates
+                update = None
+            feed.reschedule(failed=update is None)
+            # the feed might have been deleted in the meantime
+            if self.feeds.get(feed.url) is feed:
+                self._schedule(feed)
+                self.store.save_feed(feed)
+            if update is None:
+                return []
+            if not fetched and feed.fetched:
+                self._log_loaded(feed)
+            return update
+
+    def close(self):
+        self.store.close()
+
+    def _schedule(self, feed):
+        heapq.heappush(self.schedule, (feed.next_poll, feed.url))
+
+    def _is_current(self, entry):
+        due, url = entry
+        feed = self.feeds.get(url)
+        return feed is not None and feed.next_poll == due
+
+    def time_to_next(self):
+        while self.schedule and not self._is_current(self.schedule[0]):
+            heapq.heappop(self.schedule)
+        if not self.schedule:
+            return None
+        return max(self.schedule[0][0] - time.time(), 0)
+
+    async def wait(self):
+        # sleeps until the next feed is due or the list of feeds changes
+        self.changed.clear()
+        try:
+            await asyncio.wait_for(self.changed.wait(), self.time_to_next())
+        except asyncio.TimeoutError:
+            pass
+
+    async def get_updates(self):
+        now = time.time()
+        due = []
+        while self.schedule and self.schedule[0][0] <= now:
+            entry = heapq.heappop(self.schedule)
+            if self._is_current(entry):
+                due.append(self.feeds[entry[1]])
+        # parsing of every changed feed happens in an executor, feeds
+        # that replied with 304 Not Modified are not parsed at all
+        with feeder_cycle_seconds.time():
+            updates = await asyncio.gather(*(self._poll(feed) for feed in due))
+        await self.store.flush()
+        return [u for update in updates for u in update]
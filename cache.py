@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''
+    Bounded in-memory cache with LRU eviction and per-entry expiration.
+    Failed lookups may be cached as well (negative entries) with their own,
+    usually shorter, ttl. Concurrent lookups of the same missing key share
+    a single fetch. Optionally the content is kept in a json file at path.
+    '''
+
+    def __init__(self, max_size=1024, ttl=3600, negative_ttl=300,
+                 path=None, dump_interval=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.path = path
+        self.dump_interval = dump_interval
+
+        # key -> (expiration timestamp, value)
+        self.entries = OrderedDict()
+        self.inflight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self.last_dump = time.time()
+        if self.path:
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, negative=False, ttl=None):
+        if ttl is None:
+            ttl = self.negative_ttl if negative else self.ttl
+        self.entries[key] = (time.time() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        if self.path and time.time() - self.last_dump >= self.dump_interval:
+            self.dump()
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return entry[1] if entry else default
+
+    def clear(self):
+        self.entries.clear()
+
+    async def get_or_fetch(self, key, fetch):
+        '''
+        Returns the cached value for key or awaits fetch() to obtain it.
+        fetch must return a (value, negative) tuple, exceptions raised out
+        of it are propagated to every waiter and not cached.
+        '''
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._fetched(key, t))
+        else:
+            self.coalesced += 1
+        # shield the shared fetch so that a cancelled waiter
+        # does not cancel it for everyone else
+        value, _ = await asyncio.shield(task)
+        return value
+
+    def _fetched(self, key, task):
+        self.inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        value, negative = task.result()
+        self.set(key, value, negative=negative)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'inflight': len(self.inflight)
+        }
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, expires, value in entries[-self.max_size:]:
+            if expires > now:
+                self.entries[key] = (expires, value)
+
+    def dump(self):
+        self.last_dump = time.time()
+        snapshot = [(key, expires, value)
+                    for key, (expires, value) in self.entries.items()]
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            loop = None
+        if loop and loop.is_running():
+            loop.run_in_executor(None, self._write, snapshot)
+        else:
+            self._write(snapshot)
+
+    def _write(self, snapshot):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
@@ -1,18 +1,206 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+
 import logbook
 from log import logger_group
+from router import split_args
+import metrics
+
+
+command_seconds = metrics.histogram('delator_command_seconds',
+                                    'Time taken by commands', ('command',))
+command_errors = metrics.counter('delator_command_errors_total',
+                                 'Commands that raised an exception', ('command',))
+
+
+class Namespace:
+    '''
+    Key/value mapping bounded to max_size entries, the least recently used
+    ones are evicted first. Entries expire ttl seconds after they were set
+    (never if ttl is None); expiry is driven by a timer set to the earliest
+    deadline instead of scanning the entries. If store is given, the
+    entries are written there and loaded back on start, so the values have
+    to be json serializable. A value changed in place has to be passed to
+    persist() to get written.
+    '''
+
+    def __init__(self, name, max_size=1024, ttl=None, store=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        # key -> (expiration timestamp or None, value)
+        self.entries = OrderedDict()
+        # heap of (expiration timestamp, sequence number, key), entries
+        # that were set again or removed are skipped when their time comes
+        self.deadlines = []
+        self.counter = itertools.count()
+        self.timer = None
+        self.timer_at = None
+        if store:
+            for key, value, expires in store.load(name)[-max_size:]:
+                self.entries[key] = (expires, value)
+                if expires is not None:
+                    heapq.heappush(self.deadlines,
+                                   (expires, next(self.counter), key))
+            # namespaces are created by the setup of a command, once the
+            # loop is running
+            self._arm()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        entry = self._lookup(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self._lookup(key) is None:
+            raise KeyError(key)
+        self.pop(key)
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= time.time():
+            # the timer hasn't fired yet
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        return default if entry is None else entry[1]
+
+    def items(self):
+        now = time.time()
+        return [(key, value) for key, (expires, value) in self.entries.items()
+                if expires is None or expires > now]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        if expires is not None:
+            heapq.heappush(self.deadlines, (expires, next(self.counter), key))
+            self._arm()
+        if self.store:
+            self.store.put(self.name, key, value, expires)
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            if self.store:
+                self.store.delete(self.name, evicted)
+
+    def persist(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.store:
+            self.store.put(self.name, key, entry[1], entry[0])
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        if self.store:
+            self.store.delete(self.name, key)
+        if entry[0] is not None and entry[0] <= time.time():
+            return default
+        return entry[1]
+
+    def clear(self):
+        for key in list(self.entries):
+            self.pop(key)
+        self.deadlines = []
+
+    def _arm(self):
+        if not self.deadlines:
+            return
+        earliest = self.deadlines[0][0]
+        if self.timer is not None:
+            if self.timer_at <= earliest:
+                return
+            self.timer.cancel()
+        loop = asyncio.get_event_loop()
+        self.timer = loop.call_later(max(earliest - time.time(), 0), self._expire)
+        self.timer_at = earliest
+
+    def _expire(self):
+        self.timer = None
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            expires, _, key = heapq.heappop(self.deadlines)
+            entry = self.entries.get(key)
+            # the store purges expired rows by itself
+            if entry is not None and entry[0] == expires:
+                del self.entries[key]
+        # keys that are set over and over again leave stale deadlines behind
+        if len(self.deadlines) > 2 * len(self.entries) + 64:
+            self.deadlines = [(expires, next(self.counter), key)
+                              for key, (expires, _) in self.entries.items()
+                              if expires is not None]
+            heapq.heapify(self.deadlines)
+        self._arm()
 
 
 class Storage:
-    pass
+    '''
+    State of a command, it survives reloads of the command module.
+    Any attribute can be set on it, bounded and optionally persistent
+    key/value mappings are obtained with namespace().
+    '''
+
+    def __init__(self, name='', store=None):
+        self._name = name
+        self._store = store
+        self._namespaces = {}
+
+    def namespace(self, name, max_size=1024, ttl=None, persistent=False):
+        '''
+        Returns the namespace called name, creating it on the first call.
+        A persistent namespace is kept in the store across restarts.
+        '''
+        namespace = self._namespaces.get(name)
+        if namespace is None:
+            store = self._store if persistent else None
+            namespace = self._namespaces[name] = Namespace(
+                f'{self._name}.{name}', max_size, ttl, store)
+        else:
+            # a reloaded module may come with different limits
+            namespace.max_size = max_size
+            namespace.ttl = ttl
+        return namespace
 
 
 class Request:
-    def __init__(self, event, room_id, bot, storage, logger):
+    def __init__(self, event, room_id, bot, storage, logger, text=''):
         self.event = event
         self.room_id = room_id
         self.bot = bot
         self.storage = storage
         self.logger = logger
+        # raw text of the arguments
+        self.text = text
+
+    @property
+    def argv(self):
+        # arguments with quoting honored
+        return split_args(self.text)
 
     async def reply(self, text, formatted=None):
         sender = self.event.sender.split('@')[1].split(':')[0]
@@ -25,29 +213,67 @@ class Request:
                 'formatted_body': content['body'],
                 'format': 'org.matrix.custom.html',
             })
-        await self.bot.client.room_send(self.room_id, 'm.room.message', content)
+        # the message is queued, the returned future can be awaited
+        # in order to wait for the actual delivery
+        return self.bot.sender.send(self.room_id, content)
 
 
 class Command:
-    def __init__(self, name, handler, aliases, help, bot):
+    def __init__(self, name, handler, aliases, help, timeout, bot,
+                 loader=None, file_path=None, main_process=False, eager=False):
         self.name = name
         self.handler = handler
         self.aliases = aliases
         self.help = help
+        self.timeout = timeout
         self.bot = bot
+        # returns the module of a command which is not imported yet
+        self.loader = loader
+        self.module = None
+        self.file_path = file_path
+        # run by the sync process even if there are worker processes
+        self.main_process = main_process
+        # loaded on start instead of the first call
+        self.eager = eager
+        self.load_lock = asyncio.Lock()
 
-        self.storage = Storage()
+        self.storage = Storage(name, getattr(bot, 'kv', None))
 
         self.logger = logbook.Logger(name)
         logger_group.add_logger(self.logger)
 
-    async def run(self, args, event, room_id):
+    async def load(self):
+        async with self.load_lock:
+            if self.handler is not None:
+                return
+            module = self.loader()
+            if hasattr(module, 'setup'):
+                await module.setup(self.storage)
+            self.module = module
+            self.handler = module.handler
+            self.logger.info(f'loaded command module {module.__file__}')
+
+    async def unload(self):
+        # lets the module release what it holds, e.g. background servers
+        module, self.module = self.module, None
+        if module and hasattr(module, 'teardown'):
+            try:
+                await module.teardown(self.storage)
+            except Exception as e:
+                self.logger.critical(f'teardown failed: {e}')
+
+    async def run(self, args, event, room_id, text=None):
+        if self.handler is None:
+            await self.load()
         request = Request(event, room_id, self.bot,
-                          self.storage, self.logger)
-        try:
-            await self.handler(args, request)
-        except Exception as e:
-            self.logger.critical(e)
+                          self.storage, self.logger,
+                          text if text is not None else ' '.join(args))
+        with command_seconds.labels(self.name).time():
+            try:
+                await self.handler(args, request)
+            except Exception as e:
+                command_errors.labels(self.name).inc()
+                self.logger.critical(e)
 
     def __repr__(self):
         return repr("%" + self.name) if not self.aliases else \
@@ -1,5 +1,7 @@
 help = ''' %olm verify/blacklist <user>
 Only specified in configuration file users are allowed to perform this command.'''
+# needs the matrix client, so it runs in the sync process
+main_process = True
 
 
 async def handler(args, request):
@@ -11,13 +13,13 @@ async def handler(args, request):
                 action_fn = request.bot.client.verify_device if action == 'verify' \
                     else request.bot.client.blacklist_device
                 device_list = []
-                for device in request.bot.client.device_store:
-                    if device.user_id == user_id:
-                        result = action_fn(device)
-                        if result:
-                            device_list.append(device.device_id)
-                            request.logger.info(f'Verified device {device.device_id} '
-                                                f'for user {device.user_id}')
+                for device in request.bot.client.device_store.active_user_devices(user_id):
+                    result = action_fn(device)
+                    if result:
+                        device_list.append(device.device_id)
+                        request.logger.info(f'Verified device {device.device_id} '
+                                            f'for user {device.user_id}')
+                request.bot.trust.invalidate([user_id])
                 if device_list:
                     await request.reply(f'These devices of user {user_id} were '
                                         f"{'verified' if action == 'verify' else 'blacklisted'}: "
@@ -1,12 +1,13 @@
+import hashlib
 import secrets
-import math
 import time
-import shlex
 import json
 import os
-import asyncio
+from collections import OrderedDict
 from aiohttp import web
 
+from cache import TTLCache
+
 name = 'poll'
 aliases = ('зщдд')
 help = '''Start, participate and get results of a poll.
@@ -22,6 +23,10 @@ You can vote only once during a poll and can not change your answer.
 In order to obtain a vote code you have to send a GET request to the url pointed out in the output of %poll start <option1,>,
 adding your choice to the end of the url separated with '/', e.g url/my%20choice.
 Ask a room moderator for details.'''
+# serves the votes over http and keeps the polls of all rooms, so it runs in the sync process
+main_process = True
+# the http server has to be up for the polls restored after a restart
+eager = True
 
 # Configuration section.
 # There's no actual need to split it up into two files I suppose,
@@ -29,10 +34,18 @@ Ask a room moderator for details.'''
 host = '127.0.0.1'
 port = '1334'
 uri = '/delator/poll/'
-code_length = 4
+id_length = 6
+code_length = 6
 poll_timeout = 3600  # in seconds
-max_polls_num = 1024
-max_codes_num = 1024  # per poll, i.e. means amount of possible participants
+max_polls_num = 65536
+max_codes_num = 65536  # per poll, i.e. means amount of possible participants
+max_stored_codes = 2 ** 20  # unused codes and cast votes kept across all polls
+max_listed_voters = 50  # bigger polls only get the distribution of votes
+max_batch = 1000  # polls or codes in a single batch request
+client_rate = 20  # requests per second allowed to a single client
+client_burst = 200  # requests a client may make at once, a code of a batch counts as a request
+max_clients = 10000  # clients whose request rate is tracked
+trust_forwarded = False  # identify clients by X-Forwarded-For, only behind a reverse proxy
 
 
 # this url is only used to display voting endpoint
@@ -44,130 +57,370 @@ else:
     poll_url = f'http://{host}:{port}{uri}'
 
 
+def permute(key, value, bits, rounds=4):
+    '''
+    Keyed bijection of the integers in [0, 2**bits) (a balanced Feistel
+    network, bits has to be even). Permuting a counter yields identifiers
+    that look random but never collide.
+    '''
+    half = bits // 2
+    mask = (1 << half) - 1
+    left, right = value >> half, value & mask
+    for round in range(rounds):
+        digest = hashlib.blake2b(bytes([round]) + right.to_bytes(8, 'big'),
+                                 key=key, digest_size=8).digest()
+        left, right = right, left ^ (int.from_bytes(digest, 'big') & mask)
+    return (left << half) | right
+
+
+class PollError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class Polls:
+    '''
+    Polls with running per-option counters, so that voting and ending a poll
+    don't depend on the amount of voters. Ids and codes are a counter run
+    through a keyed permutation, so they are unique without retrying. Polls
+    are kept in persistent storage namespaces that expire them on time.
+    Codes and answers are stored under keys of their own, next to the poll
+    record, so issuing a code or voting writes a bounded amount of data.
+    '''
+
+    def __init__(self, storage):
+        self.polls = storage.namespace('polls', max_size=max_polls_num,
+                                       ttl=poll_timeout, persistent=True)
+        # '<id>:<code>' -> index of the option
+        self.codes = storage.namespace('codes', max_size=max_stored_codes,
+                                       ttl=poll_timeout, persistent=True)
+        # '<id>:<voter>' -> index of the option
+        self.answers = storage.namespace('answers', max_size=max_stored_codes,
+                                         ttl=poll_timeout, persistent=True)
+        self.meta = storage.namespace('meta', persistent=True)
+        if 'ids' not in self.meta:
+            self.meta['ids'] = {'key': secrets.token_hex(16), 'issued': 0}
+        # options never change, so they are serialized once per poll
+        self.serialized = TTLCache(max_size=max_polls_num, ttl=poll_timeout)
+        self._migrate()
+
+    def _migrate(self):
+        # codes and answers used to be kept inside of the poll record
+        for id, poll in self.polls.items():
+            if 'codes' not in poll:
+                continue
+            ttl = self._remaining(poll)
+            for code, option in poll.pop('codes').items():
+                self.codes.set(f'{id}:{code}', option, ttl)
+            answers = poll.pop('answers')
+            for voter, option in answers.items():
+                self.answers.set(f'{id}:{voter}', option, ttl)
+            poll['listed'] = dict(list(answers.items())[:max_listed_voters])
+            self.polls.persist(id)
+
+    def _remaining(self, poll):
+        # codes and answers expire along with their poll
+        return max(poll['timestamp'] + poll_timeout - time.time(), 1)
+
+    def __len__(self):
+        return len(self.polls)
+
+    def __contains__(self, id):
+        return id in self.polls
+
+    def get(self, id):
+        poll = self.polls.get(id)
+        if poll is None:
+            raise PollError(f'A poll with id {id} does not exist.', 404)
+        return poll
+
+    def options(self, id):
+        '''
+        Returns the json of the options of a poll and its ETag.
+        '''
+        entry = self.serialized.get(id)
+        if entry is None or id not in self.polls:
+            options = self.get(id)['options']
+            body = json.dumps({'options': options}).encode()
+            etag = '"' + hashlib.blake2b(id.encode() + body, digest_size=8).hexdigest() + '"'
+            entry = (body, etag)
+            self.serialized.set(id, entry)
+        return entry
+
+    def start(self, creator, options):
+        if len(self.polls) >= max_polls_num:
+            raise PollError('The maximum amount of started polls is exceeded. '
+                            'Wait until some of them eventually time out.', 403)
+        ids = self.meta['ids']
+        key = bytes.fromhex(ids['key'])
+        while True:
+            # the counter wraps around, an id still in use is skipped
+            number = ids['issued'] % 16 ** id_length
+            ids['issued'] += 1
+            id = format(permute(key, number, 4 * id_length), f'0{id_length}x')
+            if id not in self.polls:
+                break
+        self.meta.persist('ids')
+        self.polls[id] = {
+            'creator': creator,
+            'timestamp': time.time(),
+            'options': options,
+            'counts': [0] * len(options),
+            # voters are only listed in the result of small polls
+            'listed': {},
+            'key': secrets.token_hex(16),
+            'issued': 0
+        }
+        return id
+
+    def issue_code(self, id, answer):
+        poll = self.get(id)
+        if poll['issued'] >= min(max_codes_num, 16 ** code_length):
+            raise PollError('The maximum amount of participants of this poll exceeded.', 403)
+        try:
+            option = poll['options'].index(answer)
+        except ValueError:
+            raise PollError(f'Invalid answer. Awailable options: {poll["options"]}')
+        code = format(permute(bytes.fromhex(poll['key']), poll['issued'],
+                              4 * code_length), f'0{code_length}x')
+        poll['issued'] += 1
+        self.polls.persist(id)
+        self.codes.set(f'{id}:{code}', option, self._remaining(poll))
+        return code
+
+    def vote(self, id, code, voter):
+        poll = self.get(id)
+        if f'{id}:{code}' not in self.codes:
+            raise PollError('Wrong code.')
+        if f'{id}:{voter}' in self.answers:
+            raise PollError('You are not allowed to vote twice in the same poll.', 403)
+        option = self.codes.pop(f'{id}:{code}')
+        self.answers.set(f'{id}:{voter}', option, self._remaining(poll))
+        poll['counts'][option] += 1
+        if len(poll['listed']) < max_listed_voters:
+            poll['listed'][voter] = option
+        self.polls.persist(id)
+
+    def end(self, id, voter):
+        poll = self.get(id)
+        if poll['creator'] != voter:
+            raise PollError('You have to be the creator of this poll in order to end it.', 403)
+        self.serialized.pop(id)
+        # its codes and answers are left to expire, a new poll can't get
+        # the same id before the counter wraps around
+        return self.polls.pop(id)
+
+
+class RateLimiter:
+    '''
+    Token bucket per client. Only the most recently seen clients are
+    tracked, so the memory stays bounded whatever the amount of clients.
+    '''
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client -> (tokens, timestamp)
+        self.buckets = OrderedDict()
+
+    def take(self, client, cost=1):
+        '''
+        Takes cost tokens from the bucket of client. Returns 0 on success
+        or the amount of seconds to wait until there are enough of them.
+        '''
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        delay = 0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            delay = (cost - tokens) / self.rate
+        self.buckets[client] = (tokens, now)
+        if len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return delay
+
+
+limiter = RateLimiter(client_rate, client_burst, max_clients)
+
+
+def client_of(request):
+    if trust_forwarded and 'X-Forwarded-For' in request.headers:
+        return request.headers['X-Forwarded-For'].split(',')[0].strip()
+    return request.remote
+
+
+def too_many_requests(delay):
+    return web.Response(text='Too many requests, slow down.', status=429,
+                        headers={'Retry-After': str(int(delay) + 1)})
+
+
+@web.middleware
+async def rate_limit(request, handler):
+    delay = limiter.take(client_of(request))
+    if delay:
+        return too_many_requests(delay)
+    return await handler(request)
+
+
+def json_response(body, etag=None):
+    headers = {'ETag': etag} if etag else None
+    return web.Response(body=body, content_type='application/json',
+                        headers=headers)
+
+
+def not_modified(request, etag):
+    return etag in request.headers.get('If-None-Match', '')
+
+
 async def get_options(request):
     id = request.match_info['id']
-    if id in polls:
-        options = {'options': polls[id]['options']}
-        return web.Response(text=json.dumps(options))
-    else:
-        return web.Response(text=f'A poll with id {id} does not exist.', status=404)
+    try:
+        body, etag = polls.options(id)
+    except PollError as e:
+        return web.Response(text=str(e), status=e.status)
+    if not_modified(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    return json_response(body, etag)
+
+
+async def get_many_options(request):
+    # ?ids=<id>,<id>,... -> {"<id>": {"options": [...]} or null}
+    ids = [id for id in request.query.get('ids', '').split(',') if id]
+    if not ids or len(ids) > max_batch:
+        return web.Response(text=f'Pass from 1 to {max_batch} comma separated ids.', status=400)
+    parts = []
+    etags = []
+    for id in ids:
+        try:
+            body, etag = polls.options(id)
+        except PollError:
+            body, etag = b'null', '-'
+        parts.append(json.dumps(id).encode() + b':' + body)
+        etags.append(etag)
+    etag = '"' + hashlib.blake2b(' '.join(etags).encode(), digest_size=8).hexdigest() + '"'
+    if not_modified(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    return json_response(b'{' + b','.join(parts) + b'}', etag)
 
 
 async def get_code(request):
     id = request.match_info['id']
     answer = request.match_info['answer']
-    if id not in polls:
-        return web.Response(text=f'A poll with id {id} does not exist.', status=404)
-    if len(polls[id]['codes']) > max_codes_num:
-        return web.Response(text=f'The maximum amount of participants of this poll exceeded.', status=403)
-    if answer not in polls[id]['options']:
-        return web.Response(text=f'Invalid answer. Awailable options: {polls[id]["options"]}', status=400)
-    num_bytes = code_length // 2 if code_length % 2 == 0 else \
-        (code_length + 1) // 2
-    while True:
-        code = secrets.token_hex(num_bytes)
-        code = code if code_length % 2 == 0 else code[1:]
-        if code not in polls[id]['codes']:
-            break
-    polls[id]['codes'][code] = answer
+    try:
+        code = polls.issue_code(id, answer)
+    except PollError as e:
+        return web.Response(text=str(e), status=e.status)
     return web.Response(text=f'Your answer code is {code}. '
                         'Now in order to use it to vote in this poll, send this to the chat:\n'
                         f'%poll {id} {code}\n')
 
 
+async def post_codes(request):
+    # [{"id": <id>, "answer": <answer>}, ...] ->
+    # [{"code": <code>} or {"error": <message>, "status": <status>}, ...]
+    try:
+        items = await request.json()
+        pairs = [(item['id'], item['answer']) for item in items]
+    except (ValueError, TypeError, KeyError):
+        return web.Response(text='Expected a json list of {"id": ..., "answer": ...} objects.',
+                            status=400)
+    # a code counts as a request, so a batch larger than the burst could
+    # never be paid for
+    limit = int(min(max_batch, limiter.burst))
+    if not pairs or len(pairs) > limit:
+        return web.Response(text=f'Pass from 1 to {limit} codes at once.', status=400)
+    # the request itself has been paid for by the middleware
+    delay = limiter.take(client_of(request), len(pairs) - 1)
+    if delay:
+        return too_many_requests(delay)
+    results = []
+    for id, answer in pairs:
+        try:
+            results.append({'code': polls.issue_code(str(id), str(answer))})
+        except PollError as e:
+            results.append({'error': str(e), 'status': e.status})
+    return web.json_response(results)
+
+
 async def init():
-    app = web.Application()
+    app = web.Application(middlewares=[rate_limit])
 
     base_uri = uri if uri.endswith('/') else uri + '/'
     options_uri = base_uri + '{id}'
     code_uri = base_uri + '{id}/{answer}'
 
+    app.router.add_get(base_uri, get_many_options)
+    app.router.add_post(base_uri + 'codes', post_codes)
     app.router.add_get(options_uri, get_options)
     app.router.add_get(code_uri, get_code)
 
-    runner = web.AppRunner(app)
+    # clients are expected to keep their connections for batches of requests
+    runner = web.AppRunner(app, keepalive_timeout=75)
     await runner.setup()
 
     site = web.TCPSite(runner, host, port)
     await site.start()
+    return runner
+
 
+polls = None
+runner = None
 
-async def cleanup():
-    while True:
-        current_timestamp = time.time()
-        ids = list(polls.keys())
-        for id in ids:
-            if id in polls and current_timestamp - polls[id]['timestamp'] >= poll_timeout:
-                polls.pop(id)
-        await asyncio.sleep(5)
 
+async def setup(storage):
+    global polls, runner
+    # polls live in the command storage so that they survive reloads and
+    # restarts, the ones that time out are dropped by the storage itself
+    polls = Polls(storage)
+    runner = await init()
 
-polls = {}
 
-asyncio.gather(init(), cleanup())
+async def teardown(storage):
+    if runner:
+        await runner.cleanup()
+
+
+def compose_result(id, poll):
+    response = f'Poll <strong>{id}</strong> has been ended.'
+    total_votes = sum(poll['counts'])
+    if not total_votes:
+        return response + ' No one voted though :('
+    dist = {}
+    for option, answer_count in zip(poll['options'], poll['counts']):
+        if answer_count:
+            dist[option] = '{:.2f}% ({})'.format(
+                answer_count * 100 / total_votes, answer_count)
+    response += ' Here is the result:\n'
+    if total_votes <= max_listed_voters:
+        response += '\n'.join([f'{p}: <strong>{poll["options"][a]}</strong>\n' for p, a
+                               in poll['listed'].items()])
+    response += f'Votes distribution: {dist}'
+    return response
 
 
 async def handler(args, request):
     if len(args) < 2:
         return await request.reply('See %help poll')
     sender = request.event.sender
-    if args[0] == 'start':
-        if len(polls) > max_polls_num:
-            return await request.reply('The maximum amount of started polls is exceeded. '
-                                       'Wait until some of them eventually time out.')
-        args = args[1:]
-        args = shlex.split(' '.join(args))
-        # in case if only one polling option is specified
-        if len(args) == 1:
-            args.append(f'not {args[0]}')
-        num_bytes = math.ceil(math.log(max_polls_num, 2) / 8)
-        id = secrets.token_hex(num_bytes)
-        while id in polls:
-            id = secrets.token_hex(num_bytes)
-        polls[id] = {
-            'creator': sender,
-            'timestamp': time.time(),
-            'options': args,
-            'codes': {},
-            'answers': {}
-        }
-        return await request.reply(f'Poll <strong>{id}</strong> has been started. '
-                                   f'Vote url: {poll_url}{id}', formatted=True)
-    if args[0] == 'end':
-        id = args[1]
-        if id not in polls:
-            return await request.reply(f'A poll with id <strong>{id}</strong> does not exist.',
-                                       formatted=True)
-        poll = polls[id]
-        if poll['creator'] != sender:
-            return await request.reply(f'You have to be the creator of this poll in order to end it.')
-        response = f'Poll <strong>{id}</strong> has been ended.'
-        if not len(poll['answers']):
-            response += ' No one voted though :('
-        else:
-            total_votes = len(poll['answers'])
-            dist = {}
-            all_answers = list(poll['answers'].values())
-            present_answers = set(all_answers)
-            for answer in present_answers:
-                answer_count = all_answers.count(answer)
-                dist[answer] = '{:.2f}% ({})'.format(
-                    answer_count * 100 / total_votes, answer_count)
-            response += ' Here is the result:\n'
-            response += '\n'.join([f'{p}: <strong>{a}</strong>\n' for p, a
-                                   in poll['answers'].items()])
-            response += f'Votes distribution: {dist}'
-        polls.pop(id)
-        return await request.reply(response, formatted=True)
-    id = args[0]
-    code = args[1]
-    if id not in polls:
-        return await request.reply(f'A poll with id <strong>{id}</strong> does not exist.', formatted=True)
-    if code not in polls[id]['codes']:
-        return await request.reply(f'Wrong code.')
-    if sender in polls[id]['answers']:
-        return await request.reply(f'You are not allowed to vote twice in the same poll.')
-    polls[id]['answers'][sender] = polls[id]['codes'][code]
-    polls[id]['codes'].pop(code)
+    try:
+        if args[0] == 'start':
+            args = request.argv[1:]
+            # in case if only one polling option is specified
+            if len(args) == 1:
+                args.append(f'not {args[0]}')
+            id = polls.start(sender, args)
+            return await request.reply(f'Poll <strong>{id}</strong> has been started. '
+                                       f'Vote url: {poll_url}{id}', formatted=True)
+        if args[0] == 'end':
+            id = args[1]
+            poll = polls.end(id, sender)
+            return await request.reply(compose_result(id, poll), formatted=True)
+        polls.vote(args[0], args[1], sender)
+    except PollError as e:
+        return await request.reply(str(e))
     return await request.reply('Voted successfully. '
                                'Now wait until the creator of this poll ends it to find out the result.')
@@ -1,8 +1,9 @@
-from lxml import html
-from urllib.parse import unquote
+from lxml import etree, html
+from urllib.parse import quote_plus, unquote
+import asyncio
 import re
 
-import config as cfg
+from cache import TTLCache
 
 
 name = 'search'
@@ -11,25 +12,57 @@ help = 'Search for a query using DuckDuckGo search engine. '\
     'Multiple arguments will be concatenated. '\
     'Calling without arguments will show the next result (if there are any).'
 
-
-async def fetch_html(url, session):
-    async with session.get(url, proxy=cfg.proxy if hasattr(cfg, 'proxy') else None) as response:
-        return await response.text()
-
-
-def parse_html(document):
-    links = list(map(lambda s: unquote(s).split('uddg=')[-1],
-                     document.xpath('//h2[contains(@class, "result__title")]/a/@href')))
-    titles = list(map(lambda e: e.text_content().strip(),
-                      document.xpath('//h2[contains(@class, "result__title")]')))
-    snippets = list(map(lambda e: e.text_content().strip(),
-                        document.xpath('//a[contains(@class, "result__snippet")]')))
-    return (links, titles, snippets)
-
-
-def compose_url(args):
+# searches remembered to show their next results, per room and user
+max_sessions = 1024
+session_ttl = 3600  # in seconds
+# results of a query are shared by every room and user that asks for them
+cache_size = 1024
+cache_ttl = 900  # in seconds
+cache_negative_ttl = 60  # for queries without results
+
+# every result is a div holding the title with the link and the snippet,
+# so a single pass over them keeps the three in line
+result_nodes = etree.XPath('//h2[contains(@class, "result__title")]/..')
+result_title = etree.XPath('./h2[contains(@class, "result__title")]')
+result_link = etree.XPath('./h2[contains(@class, "result__title")]/a/@href')
+result_snippet = etree.XPath('.//a[contains(@class, "result__snippet")]')
+
+
+async def fetch_html(url, http):
+    async with http.get(url) as response:
+        response.raise_for_status()
+        return await http.text(response)
+
+
+def parse_html(text):
+    results = []
+    for node in result_nodes(html.fromstring(text)):
+        titles = result_title(node)
+        links = result_link(node)
+        if not titles or not links:
+            continue
+        link = unquote(links[0]).split('uddg=')[-1]
+        title = titles[0].text_content().strip()
+        if 'ad_provider' in link or 'Ad\n' in title:
+            continue
+        snippets = result_snippet(node)
+        results.append({
+            'link': link,
+            'title': cut_off_extra_spacing(title),
+            'snippet': cut_off_extra_spacing(
+                snippets[0].text_content().strip() if snippets else '')
+        })
+    return results
+
+
+def normalize_query(args):
+    # queries differing only in case and spacing share their results
+    return ' '.join(' '.join(args).split()).casefold()
+
+
+def compose_url(query):
     endpoint = 'https://duckduckgo.com/html/'
-    return f"{endpoint}?q={'+'.join(args)}"
+    return f'{endpoint}?q={quote_plus(query)}'
 
 
 def compose_response(result):
@@ -42,48 +75,48 @@ def cut_off_extra_spacing(s):
     return re.sub('\n\s*\n', '', s)
 
 
+async def search(query, http):
+    text = await fetch_html(compose_url(query), http)
+    # lxml holds the loop for the whole page otherwise
+    loop = asyncio.get_event_loop()
+    results = await loop.run_in_executor(None, parse_html, text)
+    return results, not results
+
+
+async def setup(storage):
+    # the cache outlives reloads of the module
+    if not hasattr(storage, 'cache'):
+        storage.cache = TTLCache(max_size=cache_size, ttl=cache_ttl,
+                                 negative_ttl=cache_negative_ttl)
+
+
 async def handler(args, request):
+    results = request.storage.namespace('results', max_size=max_sessions,
+                                        ttl=session_ttl)
+    key = (request.room_id, request.event.sender)
     if args:
+        query = normalize_query(args)
         try:
-            text = await fetch_html(compose_url(args),
-                                    request.bot.http_session)
+            # identical queries running at the same time share the request
+            found = await request.storage.cache.get_or_fetch(
+                query, lambda: search(query, request.bot.http))
         except Exception as e:
             request.logger.critical('something went wrong during fetching '
                                     f'request from the search engine: {e}')
-            await request.reply(f'{e}')
-
-        document = html.fromstring(text)
-
-        if not hasattr(request.storage, 'search_results'):
-            request.storage.search_results = {}
-        sr = request.storage.search_results
-        if request.room_id not in sr:
-            sr[request.room_id] = {}
-        sr[request.room_id][request.event.sender] = {
-            'results': [], 'pointer': 0
-        }
-
-        for link, title, snippet in zip(*parse_html(document)):
-            if 'ad_provider' in link or 'Ad\n' in title:
-                continue
-            title = cut_off_extra_spacing(title)
-            snippet = cut_off_extra_spacing(snippet)
-            sr[request.room_id][request.event.sender]['results'].append({
-                'link': link,
-                'title': title,
-                'snippet': snippet
-            })
-    try:
-        srd = request.storage.search_results[request.room_id][request.event.sender]
-        if srd['results']:
-            result = srd['results'][srd['pointer']]
-            srd['pointer'] += 1
-        else:
-            result = None
-        response = compose_response(result)
-    except (AttributeError, KeyError):
+            return await request.reply(f'{e}')
+        # the cached list is shared, only the pointer belongs to the user
+        results[key] = {'results': found, 'pointer': 0}
+
+    session = results.get(key)
+    if session is None:
         response = 'you must specify your search query first'
-    except IndexError:
+    elif session['pointer'] >= len(session['results']) > 0:
         response = 'the end of results list, try to refine your query'
-        del request.storage.search_results[request.room_id][request.event.sender]
+        results.pop(key)
+    else:
+        result = None
+        if session['results']:
+            result = session['results'][session['pointer']]
+            session['pointer'] += 1
+        response = compose_response(result)
     await request.reply(response, formatted=True)
@@ -0,0 +1,28 @@
+name = 'stalls'
+help = '''%stalls [<number>] | reset
+Shows the call sites that blocked the event loop for the longest total time.
+Only available when the bot runs with --watchdog and only for manager accounts.'''
+# reports the event loop of the sync process, so it runs in the sync process
+main_process = True
+
+
+async def handler(args, request):
+    if request.event.sender not in request.bot.cfg.manager_accounts:
+        return
+    watchdog = request.bot.watchdog
+    if not watchdog:
+        return await request.reply('The watchdog is disabled, run the bot with --watchdog.')
+    if args and args[0] == 'reset':
+        watchdog.reset()
+        return await request.reply('Stall statistics have been reset.')
+    try:
+        number = int(args[0]) if args else 5
+    except ValueError:
+        return await request.reply(help)
+    top = watchdog.top(number)
+    if not top:
+        return await request.reply(f'No stalls longer than {watchdog.threshold}s so far.')
+    lines = [f'<strong>{site}</strong>: {stall.count} stalls, '
+             f'{stall.total:.2f}s total, {stall.max:.2f}s max (blocked in {stall.leaf})'
+             for site, stall in top]
+    await request.reply('event loop stalls:\n' + '\n'.join(lines), formatted=True)
@@ -0,0 +1,87 @@
+import asyncio
+from collections import deque
+
+import logbook
+
+from log import logger_group
+import config as cfg
+import metrics
+
+
+timeouts = metrics.counter('delator_dispatch_timeouts_total',
+                           'Jobs cancelled because of their timeout', ('job',))
+pending_jobs = metrics.gauge('delator_dispatch_pending_jobs',
+                             'Jobs waiting for their turn in the dispatcher')
+
+
+class Dispatcher:
+    '''
+    Runs event handlers as background tasks so that the sync loop never
+    waits for them. Jobs submitted to the same lane (e.g. a room) run one
+    after another in submission order, different lanes run concurrently,
+    limited by a global amount of workers.
+    '''
+    workers = getattr(cfg, 'dispatch_workers', 32)
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(self.workers)
+        # lane -> deque of (job, timeout, name)
+        self.lanes = {}
+        # lane -> task serving the lane
+        self.tasks = {}
+        self.closing = False
+
+        self.logger = logbook.Logger('dispatcher')
+        logger_group.add_logger(self.logger)
+        pending_jobs.set_function(self.pending)
+
+    def submit(self, lane, job, timeout=None, name=None):
+        '''
+        Schedules job, a coroutine function without arguments,
+        to run in lane with an optional timeout in seconds.
+        '''
+        if self.closing:
+            self.logger.warning(f'shutting down, dropped job {name or job}')
+            return
+        self.lanes.setdefault(lane, deque()).append((job, timeout, name))
+        if lane not in self.tasks:
+            self.tasks[lane] = asyncio.ensure_future(self._serve_lane(lane))
+
+    def pending(self):
+        return sum(map(len, self.lanes.values()))
+
+    async def _run(self, job, timeout, name):
+        async with self.semaphore:
+            try:
+                await asyncio.wait_for(job(), timeout)
+            except asyncio.TimeoutError:
+                timeouts.labels(name).inc()
+                self.logger.error(f'job {name or job} timed out after {timeout}s')
+            except Exception as e:
+                self.logger.critical(f'job {name or job} failed: {e}')
+
+    async def _serve_lane(self, lane):
+        queue = self.lanes[lane]
+        try:
+            while queue:
+                await self._run(*queue.popleft())
+        finally:
+            self.tasks.pop(lane, None)
+            if not queue:
+                self.lanes.pop(lane, None)
+
+    async def shutdown(self, timeout=None):
+        '''
+        Stops accepting new jobs and waits for the submitted ones to finish,
+        the ones still running after timeout seconds are cancelled.
+        '''
+        self.closing = True
+        tasks = list(self.tasks.values())
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            self.logger.warning(f'cancelled {len(pending)} lanes on shutdown')
+            await asyncio.gather(*pending, return_exceptions=True)
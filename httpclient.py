@@ -0,0 +1,112 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+import config as cfg
+import metrics
+
+
+request_seconds = metrics.histogram('delator_http_first_byte_seconds',
+                                    'Time until the response headers of outgoing requests')
+received_bytes = metrics.counter('delator_http_received_bytes_total',
+                                 'Bytes of response bodies received by outgoing requests')
+request_errors = metrics.counter('delator_http_errors_total',
+                                 'Outgoing requests that failed', ('reason',))
+
+
+class ResponseTooLarge(aiohttp.ClientError):
+    pass
+
+
+class HTTPClient:
+    '''
+    HTTP client shared by everything the bot fetches (link previews, search,
+    feeds), so that connections and resolved addresses are reused. The
+    connector bounds the amount of connections in total and per host, and
+    every request is bounded in time (connecting, waiting for the first
+    byte, each read and the whole request) and in the size of the response.
+    '''
+    # connections in total and per host
+    limit = getattr(cfg, 'http_limit', 100)
+    limit_per_host = getattr(cfg, 'http_limit_per_host', 8)
+    # how long in seconds resolved addresses and idle connections are kept
+    dns_cache_ttl = getattr(cfg, 'http_dns_cache_ttl', 300)
+    keepalive_timeout = getattr(cfg, 'http_keepalive_timeout', 30)
+    # timeouts in seconds
+    connect_timeout = getattr(cfg, 'http_connect_timeout', 10)
+    first_byte_timeout = getattr(cfg, 'http_first_byte_timeout', 15)
+    read_timeout = getattr(cfg, 'http_read_timeout', 15)
+    total_timeout = getattr(cfg, 'http_total_timeout', 60)
+    # responses are not read beyond this size, in bytes
+    max_response_size = getattr(cfg, 'http_max_response_size', 10 * 2**20)
+    proxy = getattr(cfg, 'proxy', None)
+
+    def __init__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout)
+        timeout = aiohttp.ClientTimeout(
+            total=self.total_timeout,
+            connect=self.connect_timeout,
+            sock_read=self.read_timeout)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'User-Agent': cfg.user_agent},
+            timeout=timeout)
+
+    @asynccontextmanager
+    async def get(self, url, **kwargs):
+        '''
+        Makes a GET request through the shared session and yields the
+        response once its headers are received. The size of the body is
+        not checked here, so that callers reading only a part of it (or
+        nothing but the headers) can handle responses of any size; read()
+        and text() enforce the limit.
+        '''
+        kwargs.setdefault('proxy', self.proxy)
+        try:
+            with request_seconds.time():
+                response = await asyncio.wait_for(
+                    self.session.get(url, **kwargs), self.first_byte_timeout)
+        except asyncio.TimeoutError:
+            request_errors.labels('first_byte_timeout').inc()
+            raise asyncio.TimeoutError(
+                f'no response from {url} in {self.first_byte_timeout}s')
+        except aiohttp.ClientError:
+            request_errors.labels('connection').inc()
+            raise
+        try:
+            yield response
+        finally:
+            # including what was buffered but not consumed before release
+            received_bytes.inc(response.content.total_bytes)
+            response.release()
+
+    async def read(self, response, limit=None):
+        '''
+        Reads the body of response, ResponseTooLarge is raised as soon as it
+        turns out to be longer than limit (max_response_size by default).
+        '''
+        limit = limit or self.max_response_size
+        if (response.content_length or 0) > limit:
+            request_errors.labels('too_large').inc()
+            raise ResponseTooLarge(
+                f'{response.url} is {response.content_length} bytes long, '
+                f'the limit is {limit}')
+        body = bytearray()
+        async for data in response.content.iter_any():
+            body += data
+            if len(body) > limit:
+                request_errors.labels('too_large').inc()
+                raise ResponseTooLarge(f'{response.url} is longer than {limit} bytes')
+        return bytes(body)
+
+    async def text(self, response, limit=None):
+        body = await self.read(response, limit)
+        return body.decode(response.get_encoding(), errors='replace')
+
+    async def close(self):
+        await self.session.close()
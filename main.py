@@ -9,7 +9,16 @@ if __name__ == '__main__':
                                  'WARNING', 'ERROR', 'CRITICAL'],
                         default='CRITICAL',
                         help='Set logging level')
+    parser.add_argument('--watchdog', '-w', action='store', type=float,
+                        nargs='?', const=0.5, default=None, metavar='THRESHOLD',
+                        help='Report event loop stalls longer than THRESHOLD '
+                        'seconds (0.5 by default) along with the blocking call')
+    parser.add_argument('--workers', '-W', action='store', type=int,
+                        default=0, metavar='N',
+                        help='Run commands and link previews in N worker '
+                        'processes, rooms are spread across them')
     args = parser.parse_args()
 
-    bot = Bot(loglevel=args.loglevel)
+    bot = Bot(loglevel=args.loglevel, watchdog=args.watchdog,
+              workers=args.workers)
     bot.serve()
@@ -0,0 +1,244 @@
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import logbook
+from aiohttp import web
+
+from log import logger_group
+import config as cfg
+
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in pairs) + '}'
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        return [(name, (), self.value)]
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        # the value is obtained by calling function at collection time
+        self.function = function
+
+    def samples(self, name):
+        return [(name, (), self.function() if self.function else self.value)]
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append((f'{name}_bucket', (('le', bound),), cumulative))
+        samples.append((f'{name}_bucket', (('le', '+Inf'),), self.count))
+        samples.append((f'{name}_sum', (), self.sum))
+        samples.append((f'{name}_count', (), self.count))
+        return samples
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        # label values -> child holding the actual value
+        self.children = {}
+        if not self.label_names:
+            self.children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        key = tuple(map(str, values))
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        # e.g. once the object the labels refer to is gone
+        self.children.pop(tuple(map(str, values)), None)
+
+    def __getattr__(self, attr):
+        # an unlabelled metric acts as its only child
+        if attr in ('inc', 'dec', 'set', 'set_function', 'observe', 'time') \
+                and not self.label_names:
+            return getattr(self.children[()], attr)
+        raise AttributeError(attr)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        for values, child in list(self.children.items()):
+            for name, extra, value in child.samples(self.name):
+                lines.append(
+                    f'{name}{_format_labels(self.label_names, values, extra)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # modules that get imported more than once keep using the same metric
+        return self.metrics.setdefault(metric.name, metric)
+
+    def expose(self):
+        return '\n'.join(m.expose() for m in self.metrics.values()) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, help, labels=()):
+    return registry.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=()):
+    return registry.register(Gauge(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=default_buckets):
+    return registry.register(Histogram(name, help, labels, buckets))
+
+
+loop_lag = histogram('delator_event_loop_lag_seconds',
+                     'Delay of the event loop in running a scheduled callback')
+
+
+class MetricsServer:
+    '''
+    Serves the metrics in Prometheus text format at http://host:port/metrics
+    and measures the lag of the event loop in the background.
+    '''
+    host = getattr(cfg, 'metrics_host', '127.0.0.1')
+    port = getattr(cfg, 'metrics_port', 1335)
+    lag_interval = getattr(cfg, 'metrics_lag_interval', 0.5)
+
+    def __init__(self):
+        self.runner = None
+        self.lag_task = None
+
+        self.logger = logbook.Logger('metrics')
+        logger_group.add_logger(self.logger)
+
+    async def get_metrics(self, request):
+        return web.Response(text=registry.expose(),
+                            content_type='text/plain', charset='utf-8')
+
+    async def _measure_lag(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            loop_lag.observe(max(loop.time() - expected, 0))
+
+    async def start(self):
+        self.lag_task = asyncio.ensure_future(self._measure_lag())
+        if self.port is None:
+            return
+
+        app = web.Application()
+        app.router.add_get('/metrics', self.get_metrics)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.logger.info(f'serving metrics at http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.lag_task:
+            self.lag_task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
@@ -0,0 +1,97 @@
+import ast
+import json
+import os
+
+import logbook
+
+from log import logger_group
+
+
+class PluginIndex:
+    '''
+    Manifests of the command modules (name, aliases, help and so on) read
+    from their source code without importing them. The index is cached in
+    a json file and an entry is only rebuilt when the mtime of its module
+    changes.
+    '''
+    # module level variables that make up a manifest
+    fields = ('name', 'aliases', 'help', 'timeout', 'main_process', 'eager')
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._load()
+        self.changed = False
+
+        self.logger = logbook.Logger('plugins')
+        logger_group.add_logger(self.logger)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        if not self.changed:
+            return
+        # worker processes share the index
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def extract(self, file_path):
+        '''
+        Returns the manifest of a module or None if it can not be obtained
+        without running the module, e.g. when help is not a literal or the
+        handler is imported or defined conditionally.
+        '''
+        with open(file_path) as f:
+            tree = ast.parse(f.read(), file_path)
+        manifest = {'handler': False}
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and \
+                    node.name == 'handler':
+                manifest['handler'] = True
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    if not isinstance(target, ast.Name):
+                        continue
+                    if target.id == 'handler':
+                        # could be anything, let the import decide
+                        return None
+                    if target.id in self.fields:
+                        if node.value is None:
+                            # a bare annotation, the value comes from elsewhere
+                            return None
+                        try:
+                            manifest[target.id] = ast.literal_eval(node.value)
+                        except ValueError:
+                            return None
+        if not manifest['handler']:
+            # imported, defined under if/try and so on, only the import
+            # can tell whether there is one
+            return None
+        return manifest
+
+    def manifest(self, file_path):
+        key = os.path.abspath(file_path)
+        mtime = os.path.getmtime(file_path)
+        entry = self.entries.get(key)
+        if entry is None or entry.get('mtime') != mtime:
+            try:
+                manifest = self.extract(file_path)
+            except SyntaxError as e:
+                self.logger.error(f'{file_path}: {e}')
+                manifest = None
+            entry = self.entries[key] = {'mtime': mtime, 'manifest': manifest}
+            self.changed = True
+        manifest = entry['manifest']
+        # json turns tuples into lists
+        if manifest and isinstance(manifest.get('aliases'), list):
+            manifest['aliases'] = tuple(manifest['aliases'])
+        return manifest
@@ -0,0 +1,87 @@
+import re
+import shlex
+
+
+def split_args(text):
+    '''
+    Splits arguments honoring quotes, e.g. 'a "b c"' gives ['a', 'b c'].
+    Falls back to plain whitespace splitting on unbalanced quotes.
+    '''
+    try:
+        return shlex.split(text)
+    except ValueError:
+        return text.split()
+
+
+class Trie:
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, word, value):
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+            # every node keeps the values of all the words passing through it
+            node.setdefault(None, set()).add(value)
+
+    def lookup(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return set()
+        return node.get(None, set())
+
+
+class Router:
+    '''
+    Maps messages to commands. Messages not starting with one of the
+    prefixes are rejected before any regular expression is involved.
+    Besides the exact names and aliases, a command can be called by any
+    prefix of its names as long as it is not shared with another command.
+    '''
+    def __init__(self, prefixes=('%',), abbreviations=True):
+        self.prefixes = tuple(sorted(prefixes, key=len, reverse=True))
+        self.first_chars = frozenset(p[0] for p in self.prefixes)
+        self.command_regex = re.compile(
+            '(?:' + '|'.join(map(re.escape, self.prefixes)) + r')([\w\d_]*)\s?(.*)$')
+        self.abbreviations = abbreviations
+        self.routes = {}
+        self.trie = Trie()
+
+    def build(self, commands):
+        '''
+        commands is a mapping of names and aliases to commands.
+        '''
+        self.routes = dict(commands)
+        self.trie = Trie()
+        for name, command in self.routes.items():
+            self.trie.insert(name, command)
+
+    def resolve(self, name):
+        command = self.routes.get(name)
+        if command is None and name and self.abbreviations:
+            candidates = self.trie.lookup(name)
+            if len(candidates) == 1:
+                command = next(iter(candidates))
+        return command
+
+    def _match(self, message):
+        # the first character check rejects most of the messages cheaply
+        if not message or message[0] not in self.first_chars:
+            return None
+        return self.command_regex.match(message)
+
+    def route(self, message):
+        '''
+        Returns a (command, args, text) tuple, where text is the raw text
+        of the arguments, or None if message is not a known command.
+        '''
+        match = self._match(message)
+        if not match:
+            return None
+        command = self.resolve(match.group(1))
+        if command is None:
+            return None
+        text = match.group(2)
+        return (command, text.split(), text)
@@ -0,0 +1,213 @@
+import asyncio
+import html
+from collections import deque
+
+import logbook
+from nio import RoomSendError
+
+from log import logger_group
+import config as cfg
+import metrics
+
+
+send_seconds = metrics.histogram('delator_room_send_seconds',
+                                 'Latency of room_send requests')
+rate_limited = metrics.counter('delator_room_send_rate_limited_total',
+                               'room_send requests rejected with M_LIMIT_EXCEEDED')
+send_errors = metrics.counter('delator_room_send_errors_total',
+                              'Messages that could not be sent')
+queued = metrics.gauge('delator_room_send_queued',
+                       'Messages waiting in the outbound queues')
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+        self.paused_until = 0
+
+    def _refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, delay):
+        loop = asyncio.get_event_loop()
+        self.paused_until = max(self.paused_until, loop.time() + delay)
+
+    async def acquire(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            now = loop.time()
+            self._refill(now)
+            if self.tokens >= 1 and now >= self.paused_until:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(max((1 - self.tokens) / self.rate,
+                                    self.paused_until - now))
+
+
+class MessageSender:
+    '''
+    Outbound message queue. Messages to the same room are sent one by one
+    in FIFO order, different rooms are served concurrently with a bound on
+    the requests in flight. All sends share a global rate limit, and the
+    messages that have piled up for a room while waiting are merged into a
+    single event.
+    '''
+    # global rate limit, messages per second and burst size
+    rate = getattr(cfg, 'send_rate', 5)
+    burst = getattr(cfg, 'send_burst', 10)
+    # room_send requests in flight at once
+    concurrency = getattr(cfg, 'send_concurrency', 16)
+    # how long to wait for more messages to the same room before sending
+    coalesce_window = getattr(cfg, 'send_coalesce_window', 0.2)
+    # merged messages are never longer than this
+    max_length = getattr(cfg, 'send_max_length', 16000)
+    max_retries = 5
+
+    def __init__(self, client):
+        self.client = client
+        self.bucket = TokenBucket(self.rate, self.burst)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        # room_id -> deque of (content, future)
+        self.queues = {}
+        # room_id -> task serving the room's queue
+        self.workers = {}
+
+        self.logger = logbook.Logger('sender')
+        logger_group.add_logger(self.logger)
+        queued.set_function(lambda: sum(map(len, self.queues.values())))
+
+    def send(self, room_id, content):
+        '''
+        Puts a message into the queue of the room and returns a future
+        that will be resolved with the response of the homeserver.
+        '''
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        # nobody is obliged to wait for the delivery
+        future.add_done_callback(
+            lambda f: f.cancelled() or f.exception())
+        self.queues.setdefault(room_id, deque()).append((content, future))
+        if room_id not in self.workers:
+            self.workers[room_id] = asyncio.ensure_future(
+                self._serve_room(room_id))
+        return future
+
+    def _mergeable(self, content):
+        return content.get('msgtype') == 'm.text' and \
+            set(content) <= {'msgtype', 'body', 'format', 'formatted_body'}
+
+    def _formatted(self, content):
+        if content.get('format') == 'org.matrix.custom.html':
+            return content['formatted_body']
+        return html.escape(content['body']).replace('\n', '<br>')
+
+    def _take_batch(self, queue):
+        batch = [queue.popleft()]
+        if not self._mergeable(batch[0][0]):
+            return batch
+        # both the plain and the formatted body of the merged message
+        # must fit, they are joined with '\n' and '<br>' respectively
+        length = len(batch[0][0]['body'])
+        formatted_length = len(self._formatted(batch[0][0]))
+        while queue and self._mergeable(queue[0][0]):
+            length += len(queue[0][0]['body']) + 1
+            formatted_length += len(self._formatted(queue[0][0])) + 4
+            if max(length, formatted_length) > self.max_length:
+                break
+            batch.append(queue.popleft())
+        return batch
+
+    def _merge(self, contents):
+        if len(contents) == 1:
+            return contents[0]
+        content = {
+            'msgtype': 'm.text',
+            'body': '\n'.join(c['body'] for c in contents)
+        }
+        if any('format' in c for c in contents):
+            content.update({
+                'format': 'org.matrix.custom.html',
+                'formatted_body': '<br>'.join(map(self._formatted, contents))
+            })
+        return content
+
+    async def _send(self, room_id, content):
+        for attempt in range(self.max_retries):
+            async with self.semaphore:
+                await self.bucket.acquire()
+                with send_seconds.time():
+                    response = await self.client.room_send(
+                        room_id, 'm.room.message', content)
+            if isinstance(response, RoomSendError) and \
+                    response.status_code == 'M_LIMIT_EXCEEDED':
+                rate_limited.inc()
+                delay = (response.retry_after_ms or 1000 * 2 ** attempt) / 1000
+                self.logger.warning(f'rate limited in room {room_id}, '
+                                    f'retrying in {delay:.2f}s')
+                # the limit applies to the account, not to the room
+                self.bucket.pause(delay)
+                continue
+            return response
+        return response
+
+    async def _serve_room(self, room_id):
+        queue = self.queues[room_id]
+        try:
+            while queue:
+                if self.coalesce_window:
+                    await asyncio.sleep(self.coalesce_window)
+                batch = self._take_batch(queue)
+                try:
+                    response = await self._send(
+                        room_id, self._merge([c for c, _ in batch]))
+                    if isinstance(response, RoomSendError):
+                        send_errors.inc()
+                        self.logger.error(f'failed to send a message to room '
+                                          f'{room_id}: {response}')
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(response)
+                except Exception as e:
+                    send_errors.inc()
+                    self.logger.error(f'failed to send a message to room '
+                                      f'{room_id}: {e}')
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                except asyncio.CancelledError:
+                    for _, future in batch:
+                        future.cancel()
+                    raise
+        finally:
+            self.workers.pop(room_id, None)
+            if not queue:
+                self.queues.pop(room_id, None)
+
+    async def drain(self, timeout=None):
+        '''
+        Waits for the queued messages to be sent, the rooms still being
+        served after timeout seconds are given up on.
+        '''
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.workers:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            await asyncio.wait(list(self.workers.values()), timeout=remaining)
+        if self.workers:
+            self.logger.warning(f'gave up sending to {len(self.workers)} rooms')
+            workers = list(self.workers.values())
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for queue in self.queues.values():
+                for _, future in queue:
+                    future.cancel()
+            self.queues.clear()
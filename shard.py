@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import itertools
+import multiprocessing
+import signal
+import time
+from bisect import bisect, insort
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import logbook
+from nio import RoomSendError, RoomSendResponse
+
+from log import logger_group
+import metrics
+
+
+forwarded = metrics.counter('delator_shard_events_total',
+                            'Events forwarded to the worker processes', ('worker',))
+restarts = metrics.counter('delator_shard_restarts_total',
+                           'Worker processes started again after they died')
+
+
+class HashRing:
+    '''
+    Consistent hashing of keys onto nodes. Every node is put on the ring
+    `replicas` times so that the keys spread evenly, adding or removing a
+    node only moves the keys of that node.
+    '''
+
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        # sorted (hash, node) pairs
+        self.ring = []
+        self.hashes = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        # stable across processes and runs, unlike hash()
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            insort(self.ring, (self._hash(f'{node}:{replica}'), node))
+        self.hashes = [h for h, _ in self.ring]
+
+    def remove(self, node):
+        self.ring = [(h, n) for h, n in self.ring if n != node]
+        self.hashes = [h for h, _ in self.ring]
+
+    def get(self, key):
+        if not self.ring:
+            raise LookupError('the ring is empty')
+        index = bisect(self.hashes, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class Channel:
+    '''
+    Asynchronous end of a multiprocessing pipe. Incoming messages are
+    passed to handler as soon as they arrive, None is passed once the other
+    end is gone. Outgoing messages are written by a single thread, so they
+    keep their order and a full pipe never blocks the event loop.
+    '''
+    # messages handled at once before giving the loop back
+    batch = 64
+
+    def __init__(self, conn, handler):
+        self.conn = conn
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.closed = False
+
+    def start(self):
+        asyncio.get_event_loop().add_reader(self.conn.fileno(), self._read)
+
+    def _read(self):
+        try:
+            for _ in range(self.batch):
+                if not self.conn.poll():
+                    return
+                self.handler(self.conn.recv())
+        except (EOFError, OSError):
+            self.close()
+            self.handler(None)
+
+    def _write(self, message):
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, OSError):
+            pass
+
+    def send(self, message):
+        if self.closed:
+            return
+        asyncio.get_event_loop().run_in_executor(
+            self.executor, self._write, message)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        asyncio.get_event_loop().remove_reader(self.conn.fileno())
+        # the messages already queued are still written
+        self.executor.shutdown(wait=True)
+        self.conn.close()
+
+
+def dump_event(event):
+    # the parts of an event the commands and link previews rely on
+    return {
+        'sender': event.sender,
+        'body': event.body,
+        'event_id': event.event_id,
+        'server_timestamp': event.server_timestamp
+    }
+
+
+class ShardSender:
+    '''
+    Stands in for MessageSender in a worker process: the messages are
+    passed to the sync process which actually sends them and reports back.
+    '''
+
+    def __init__(self, channel):
+        self.channel = channel
+        # request id -> future of the delivery
+        self.futures = {}
+        self.counter = itertools.count()
+
+    def send(self, room_id, content):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        # nobody is obliged to wait for the delivery
+        future.add_done_callback(
+            lambda f: f.cancelled() or f.exception())
+        request_id = next(self.counter)
+        self.futures[request_id] = future
+        self.channel.send(('send', request_id, room_id, content))
+        return future
+
+    def resolve(self, request_id, room_id, outcome, data):
+        future = self.futures.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if outcome == 'sent':
+            future.set_result(RoomSendResponse(data, room_id))
+        elif outcome == 'error':
+            future.set_result(RoomSendError(*data))
+        else:
+            future.set_exception(RuntimeError(data))
+
+    async def drain(self, timeout=None):
+        if self.futures:
+            await asyncio.wait(list(self.futures.values()), timeout=timeout)
+
+
+def run_worker(index, conn, loglevel):
+    # ^C reaches the whole process group, the supervisor stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from bot import WorkerBot
+    WorkerBot(index, conn, loglevel=loglevel).serve()
+
+
+class ShardPool:
+    '''
+    Worker processes running the commands and link previews of the sync
+    process. Rooms are assigned to the workers by consistent hashing of
+    room_id, so the events of a room are always handled by the same worker
+    in the order they were received. The replies come back over the pipe
+    and are sent by the sync process. A worker that dies is started again
+    after a delay that doubles with every death in a row, so that a worker
+    failing on boot doesn't spin.
+    '''
+    # seconds before a dead worker is started again, doubled up to the
+    # maximum while it keeps dying shortly after its start
+    restart_delay = 1
+    max_restart_delay = 300
+    # a worker alive for that long is considered healthy again
+    healthy_after = 60
+
+    def __init__(self, bot, workers, loglevel=None):
+        self.bot = bot
+        self.size = workers
+        self.loglevel = loglevel
+        self.ring = HashRing(range(workers))
+        # room_id -> index of the worker
+        self.assigned = {}
+        self.processes = [None] * workers
+        self.channels = [None] * workers
+        # deaths in a row, start times and pending restarts of the workers
+        self.failures = [0] * workers
+        self.started = [None] * workers
+        self.restarts = [None] * workers
+        self.closing = False
+        self.context = multiprocessing.get_context('spawn')
+
+        self.logger = logbook.Logger('shard')
+        logger_group.add_logger(self.logger)
+
+    def _spawn(self, index):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(
+            target=run_worker, args=(index, child, self.loglevel),
+            name=f'delator-worker-{index}', daemon=True)
+        process.start()
+        child.close()
+        channel = Channel(parent, partial(self._receive, index))
+        channel.start()
+        self.processes[index] = process
+        self.channels[index] = channel
+        self.started[index] = time.monotonic()
+        self.restarts[index] = None
+        self.logger.info(f'started worker {index} (pid {process.pid})')
+
+    def start(self):
+        for index in range(self.size):
+            self._spawn(index)
+
+    def submit(self, room_id, event):
+        index = self.assigned.get(room_id)
+        if index is None:
+            index = self.assigned[room_id] = self.ring.get(room_id)
+        forwarded.labels(index).inc()
+        self.channels[index].send(('event', room_id, dump_event(event)))
+
+    def _receive(self, index, message):
+        if message is None:
+            if not self.closing:
+                self._schedule_restart(index)
+            return
+        if message[0] == 'send':
+            _, request_id, room_id, content = message
+            future = self.bot.sender.send(room_id, content)
+            future.add_done_callback(
+                partial(self._report, index, request_id, room_id))
+
+    def _schedule_restart(self, index):
+        self.processes[index].join(0)
+        if time.monotonic() - self.started[index] >= self.healthy_after:
+            self.failures[index] = 0
+        delay = min(self.restart_delay * 2 ** self.failures[index],
+                    self.max_restart_delay)
+        self.failures[index] += 1
+        # the events of its rooms have nowhere else to go meanwhile
+        self.logger.critical(
+            f'worker {index} died (exit code {self.processes[index].exitcode}, '
+            f'{self.failures[index]} in a row), starting it again in {delay}s')
+        self.restarts[index] = asyncio.get_event_loop().call_later(
+            delay, self._restart, index)
+
+    def _restart(self, index):
+        if self.closing:
+            return
+        restarts.inc()
+        self._spawn(index)
+
+    def _report(self, index, request_id, room_id, future):
+        if future.cancelled():
+            outcome, data = 'exception', 'cancelled'
+        elif future.exception():
+            outcome, data = 'exception', str(future.exception())
+        else:
+            response = future.result()
+            if isinstance(response, RoomSendError):
+                outcome, data = 'error', (response.message, response.status_code)
+            else:
+                outcome, data = 'sent', response.event_id
+        self.channels[index].send(('sent', request_id, room_id, outcome, data))
+
+    async def stop(self, timeout=None):
+        '''
+        Asks the workers to finish the handlers they are running, the ones
+        still alive after timeout seconds are terminated.
+        '''
+        self.closing = True
+        for handle in self.restarts:
+            if handle:
+                handle.cancel()
+        for channel in self.channels:
+            if channel:
+                channel.send(('stop',))
+        loop = asyncio.get_event_loop()
+        processes = [p for p in self.processes if p]
+        # replies keep coming in while the workers finish
+        await asyncio.gather(*(loop.run_in_executor(None, p.join, timeout)
+                               for p in processes))
+        for process in processes:
+            if process.is_alive():
+                self.logger.warning(f'terminating {process.name}')
+                process.terminate()
+        for channel in self.channels:
+            if channel:
+                channel.close()
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+import logbook
+
+from log import logger_group
+import metrics
+
+
+stalls_total = metrics.counter('delator_loop_stalls_total',
+                               'Event loop stalls longer than the watchdog threshold')
+
+root = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stall:
+    __slots__ = ('count', 'total', 'max', 'leaf')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.leaf = None
+
+
+class Watchdog:
+    '''
+    Detects stalls of the event loop and finds out what caused them.
+    A coroutine on the loop keeps a heartbeat, a separate thread watches
+    it and, as soon as the heartbeat is late by more than threshold seconds,
+    captures the stack of the loop thread, i.e. of the blocking call.
+    Stalls are aggregated by call site: the innermost frame of the bot's
+    own code, the frame of the blocking function itself is kept as well.
+    '''
+
+    def __init__(self, threshold=0.5, interval=0.05):
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None
+        # (call site, leaf, formatted stack) captured during the current stall
+        self.captured = None
+        # call site -> Stall
+        self.stalls = {}
+        self.running = False
+        self.task = None
+
+        self.logger = logbook.Logger('watchdog')
+        logger_group.add_logger(self.logger)
+
+    def _where(self, entry):
+        filename = entry.filename
+        if filename.startswith(root):
+            filename = os.path.relpath(filename, root)
+        return f'{filename}:{entry.lineno} in {entry.name}'
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame)
+        site = stack[-1]
+        for entry in reversed(stack):
+            filename = os.path.abspath(entry.filename)
+            if filename.startswith(root) and filename != os.path.abspath(__file__):
+                site = entry
+                break
+        return (self._where(site), self._where(stack[-1]),
+                ''.join(traceback.format_list(stack[-12:])))
+
+    def _watch(self):
+        while self.running:
+            time.sleep(self.interval / 2)
+            if self.captured is None and \
+                    time.monotonic() - self.heartbeat > self.threshold:
+                self.captured = self._capture()
+
+    def _record(self, lag):
+        site, leaf, stack = self.captured or ('unknown', None, '')
+        self.captured = None
+        stall = self.stalls.get(site)
+        if stall is None:
+            stall = self.stalls[site] = Stall()
+        stall.count += 1
+        stall.total += lag
+        stall.max = max(stall.max, lag)
+        stall.leaf = leaf
+        stalls_total.inc()
+        self.logger.warning(f'event loop stalled for {lag:.3f}s at {site}'
+                            f'{f" ({leaf})" if leaf else ""}\n{stack}')
+
+    async def _beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self.heartbeat - self.interval
+            if lag > self.threshold:
+                self._record(lag)
+            else:
+                # a capture that happened right before the loop resumed
+                self.captured = None
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.running = True
+        threading.Thread(target=self._watch, name='watchdog',
+                         daemon=True).start()
+        self.task = asyncio.ensure_future(self._beat())
+        self.logger.info(f'watching for event loop stalls longer than {self.threshold}s')
+
+    def stop(self):
+        self.running = False
+        if self.task:
+            self.task.cancel()
+
+    def top(self, n=10):
+        '''
+        Returns n (call site, Stall) pairs with the largest total stall time.
+        '''
+        return sorted(self.stalls.items(),
+                      key=lambda item: item[1].total, reverse=True)[:n]
+
+    def reset(self):
+        self.stalls.clear()
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import logbook
+
+from log import logger_group
+
+
+class FeedStore:
+    '''
+    SQLite-backed state of the followed feeds: conditional GET validators,
+    scheduling state, a bit of metadata for listing, the rooms subscribed
+    to every feed and a bounded set of hashes of the entries that have
+    already been seen.
+    Changes are accumulated in memory and written in batches by flush().
+    '''
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS feeds (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            modified TEXT,
+            last_poll REAL,
+            next_poll REAL,
+            errors INTEGER NOT NULL DEFAULT 0,
+            title TEXT,
+            link TEXT
+        );
+        CREATE TABLE IF NOT EXISTS seen (
+            url TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            seen_at REAL NOT NULL,
+            PRIMARY KEY (url, hash)
+        );
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            url TEXT NOT NULL,
+            room_id TEXT NOT NULL,
+            PRIMARY KEY (url, room_id)
+        );
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        # every query runs in this single thread once the bot is running
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.schema)
+        self.db.commit()
+
+        self.pending_feeds = {}
+        self.pending_seen = []
+        # url -> amount of hashes of the feed to keep
+        self.pending_limits = {}
+        self.pending_deletes = set()
+        # (url, room_id) -> True to subscribe, False to unsubscribe
+        self.pending_subscriptions = {}
+
+    def load(self):
+        feeds = {}
+        rows = self.db.execute(
+            'SELECT url, etag, modified, last_poll, next_poll, errors, title, link '
+            'FROM feeds')
+        for url, etag, modified, last_poll, next_poll, errors, title, link in rows:
+            feeds[url] = {
+                'etag': etag,
+                'modified': modified,
+                'last_poll': last_poll,
+                'next_poll': next_poll,
+                'errors': errors,
+                'title': title,
+                'link': link,
+                'seen': [],
+                'rooms': []
+            }
+        rows = self.db.execute('SELECT url, hash FROM seen ORDER BY seen_at')
+        for url, digest in rows:
+            if url in feeds:
+                feeds[url]['seen'].append(digest)
+        rows = self.db.execute('SELECT url, room_id FROM subscriptions')
+        for url, room_id in rows:
+            if url in feeds:
+                feeds[url]['rooms'].append(room_id)
+        return feeds
+
+    def save_feed(self, feed):
+        self.pending_deletes.discard(feed.url)
+        self.pending_feeds[feed.url] = (
+            feed.url, feed.etag, feed.modified, feed.last_poll, feed.next_poll,
+            feed.errors, feed.feed.feed.get('title'), feed.feed.feed.get('link'))
+        self.pending_seen += [(feed.url, digest, seen_at)
+                              for digest, seen_at in feed.unsaved_seen]
+        if feed.unsaved_seen:
+            # the same limit the feed applies in memory
+            self.pending_limits[feed.url] = feed.seen_capacity()
+        feed.unsaved_seen = []
+
+    def delete_feed(self, url):
+        self.pending_feeds.pop(url, None)
+        self.pending_seen = [s for s in self.pending_seen if s[0] != url]
+        self.pending_limits.pop(url, None)
+        self.pending_subscriptions = {key: subscribed for key, subscribed
+                                      in self.pending_subscriptions.items()
+                                      if key[0] != url}
+        self.pending_deletes.add(url)
+
+    def subscribe(self, url, room_id):
+        self.pending_subscriptions[(url, room_id)] = True
+
+    def unsubscribe(self, url, room_id):
+        self.pending_subscriptions[(url, room_id)] = False
+
+    def _write(self, feeds, seen, limits, deletes, subscriptions):
+        with self.db:
+            self.db.executemany('DELETE FROM feeds WHERE url = ?',
+                                [(url,) for url in deletes])
+            self.db.executemany('DELETE FROM seen WHERE url = ?',
+                                [(url,) for url in deletes])
+            self.db.executemany('DELETE FROM subscriptions WHERE url = ?',
+                                [(url,) for url in deletes])
+            self.db.executemany(
+                'INSERT OR IGNORE INTO subscriptions VALUES (?, ?)',
+                [key for key, subscribed in subscriptions.items() if subscribed])
+            self.db.executemany(
+                'DELETE FROM subscriptions WHERE url = ? AND room_id = ?',
+                [key for key, subscribed in subscriptions.items() if not subscribed])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                feeds)
+            self.db.executemany(
+                'INSERT OR IGNORE INTO seen VALUES (?, ?, ?)', seen)
+            # keep only the latest hashes of every feed that got new ones
+            self.db.executemany(
+                'DELETE FROM seen WHERE url = ? AND hash NOT IN '
+                '(SELECT hash FROM seen WHERE url = ? ORDER BY seen_at DESC LIMIT ?)',
+                [(url, url, limit) for url, limit in limits.items()])
+
+    def _take_pending(self):
+        pending = (list(self.pending_feeds.values()),
+                   self.pending_seen, self.pending_limits,
+                   list(self.pending_deletes), self.pending_subscriptions)
+        self.pending_feeds = {}
+        self.pending_seen = []
+        self.pending_limits = {}
+        self.pending_deletes = set()
+        self.pending_subscriptions = {}
+        return pending
+
+    def commit(self):
+        # synchronous flush, for use outside of the event loop
+        self._write(*self._take_pending())
+
+    async def flush(self):
+        if not (self.pending_feeds or self.pending_seen or self.pending_deletes
+                or self.pending_subscriptions):
+            return
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._write,
+                                   *self._take_pending())
+
+    def close(self):
+        self.executor.shutdown()
+        self.commit()
+        self.db.close()
+
+
+class KVStore:
+    '''
+    SQLite-backed values of the persistent command storage namespaces.
+    Keys and values are stored as json. Changes are accumulated in memory
+    and written in batches flush_interval seconds after the first of them,
+    expired rows are purged on every write.
+    '''
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS kv (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires REAL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        );
+    '''
+
+    def __init__(self, path, flush_interval=5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # worker processes may write to the same database
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.executescript(self.schema)
+        self.db.commit()
+
+        # (namespace, key) -> (value, expires, updated) or None to delete it
+        self.pending = {}
+        self.flush_handle = None
+
+        self.logger = logbook.Logger('store')
+        logger_group.add_logger(self.logger)
+
+    def load(self, namespace):
+        '''
+        Returns the live (key, value, expires) entries of namespace,
+        the least recently updated first.
+        '''
+        rows = self.db.execute(
+            'SELECT key, value, expires FROM kv WHERE namespace = ? AND '
+            '(expires IS NULL OR expires > ?) ORDER BY updated',
+            (namespace, time.time()))
+        entries = []
+        for key, value, expires in rows:
+            key = json.loads(key)
+            # json turns tuples into lists
+            if isinstance(key, list):
+                key = tuple(key)
+            entries.append((key, json.loads(value), expires))
+        return entries
+
+    def put(self, namespace, key, value, expires=None):
+        # the value is serialized when the batch is taken, so a value that
+        # keeps changing in place (e.g. a poll being voted in) costs one
+        # serialization per batch rather than one per change
+        self.pending[(namespace, json.dumps(key))] = (
+            value, expires, time.time())
+        self._schedule_flush()
+
+    def delete(self, namespace, key):
+        self.pending[(namespace, json.dumps(key))] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_handle is not None:
+            return
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            self.flush_handle = loop.call_later(
+                self.flush_interval, lambda: asyncio.ensure_future(self.flush()))
+
+    def _write(self, pending):
+        deletes = [key for key, row in pending.items() if row is None]
+        rows = [(*key, *row) for key, row in pending.items() if row is not None]
+        with self.db:
+            self.db.executemany('DELETE FROM kv WHERE namespace = ? AND key = ?',
+                                deletes)
+            self.db.executemany('INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?, ?)',
+                                rows)
+            self.db.execute('DELETE FROM kv WHERE expires <= ?', (time.time(),))
+
+    def _take_pending(self):
+        pending, self.pending = self.pending, {}
+        for key, row in list(pending.items()):
+            if row is None:
+                continue
+            value, expires, updated = row
+            try:
+                pending[key] = (json.dumps(value), expires, updated)
+            except (TypeError, ValueError) as e:
+                # the previously stored value is kept
+                self.logger.error(f'unable to store {key}: {e}')
+                del pending[key]
+        return pending
+
+    def commit(self):
+        # synchronous flush, for use outside of the event loop
+        self._write(self._take_pending())
+
+    async def flush(self):
+        self.flush_handle = None
+        if not self.pending:
+            return
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._write,
+                                   self._take_pending())
+
+    def close(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.executor.shutdown()
+        self.commit()
+        self.db.close()
@@ -0,0 +1,38 @@
+import config as cfg
+
+
+class TrustCache:
+    '''
+    Whether all the active devices of a user are verified, indexed by
+    user_id. Entries are computed on demand and dropped whenever the
+    devices of the user change or get (un)verified.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.verified = {}
+        # with encryption turned off in the configuration there are no
+        # devices to verify, so everyone is trusted
+        self.encryption = getattr(cfg, 'encryption', True)
+
+    def _compute(self, user_id):
+        if not self.encryption:
+            return True
+        if self.client.olm is None:
+            # the keys aren't loaded (yet), nobody can be verified
+            return False
+        devices = self.client.device_store.active_user_devices(user_id)
+        return all(map(lambda d: d.trust_state.value == 1, devices))
+
+    def is_verified(self, user_id):
+        verified = self.verified.get(user_id)
+        if verified is None:
+            verified = self.verified[user_id] = self._compute(user_id)
+        return verified
+
+    def invalidate(self, user_ids):
+        for user_id in user_ids:
+            self.verified.pop(user_id, None)
+
+    def clear(self):
+        self.verified.clear()